@@ -1,14 +1,33 @@
 import os
 import logging
 import asyncio
-import requests
-from aiogram import Bot, Dispatcher, F
+import csv
+import html
+import io
+import math
+import hashlib
+import json
+import re
+import signal
+import sys
+import sqlite3
+import threading
+import time
+import traceback
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urljoin
+import httpx
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, F
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.enums import ParseMode
-from aiogram.filters import CommandStart
-from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton
+from aiogram.exceptions import TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
+from aiogram.filters import Command, CommandObject, CommandStart
+from aiogram.types import Message, ReplyKeyboardMarkup, KeyboardButton, Update
 from aiogram.client.default import DefaultBotProperties
 from dotenv import load_dotenv
-from bs4 import BeautifulSoup
+from lxml import html as lxml_html
 
 # --- Загружаем переменные окружения ---
 load_dotenv()
@@ -18,6 +37,52 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 OPENROUTER_KEY = os.getenv("OPENROUTER_KEY")
 SCHEDULE_URL = os.getenv("SCHEDULE_URL")
 SITE_URL = os.getenv("SITE_URL", "https://kktis.kz/")
+OPENROUTER_URL = "https://openrouter.ai/api/v1/chat/completions"
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "20"))
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "0") == "1"
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))  # сек. между правками сообщения
+ANSWER_CACHE_SIZE = int(os.getenv("ANSWER_CACHE_SIZE", "1000"))
+ANSWER_CACHE_TTL = float(os.getenv("ANSWER_CACHE_TTL", "3600"))  # сек.
+SITE_PAGES = [p.strip() for p in os.getenv("SITE_PAGES", "").split(",") if p.strip()]  # доп. страницы сайта
+CRAWL_INTERVAL = float(os.getenv("CRAWL_INTERVAL", "3600"))  # сек. между обходами сайта
+SCHEDULE_SOURCE_URL = os.getenv("SCHEDULE_SOURCE_URL")  # CSV/HTML; по умолчанию — экспорт SCHEDULE_URL в CSV
+SCHEDULE_REFRESH_INTERVAL = float(os.getenv("SCHEDULE_REFRESH_INTERVAL", "1800"))  # сек.
+SITE_PAGE_MAX_CHARS = int(os.getenv("SITE_PAGE_MAX_CHARS", "20000"))
+BOT_MODE = os.getenv("BOT_MODE", "polling")  # polling | webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL")  # публичный адрес, например https://bot.example.kz/webhook
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET")  # обязателен в режиме webhook
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", os.getenv("WEBHOOK_PORT", "8080")))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "32"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 — не поднимать /metrics
+PROFILE_SLOW_UPDATE_MS = float(os.getenv("PROFILE_SLOW_UPDATE_MS", "0"))  # 0 — профилировщик выключен
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))  # сек. между снимками стека
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "30"))  # сек. на завершение начатых запросов
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "25"))  # сообщений в секунду на бота
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))  # сообщений в секунду на чат
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "8"))
+TYPING_INTERVAL = float(os.getenv("TYPING_INTERVAL", "4.5"))  # «печатает…» в Telegram гаснет через ~5 с
+ADMIN_IDS = {int(i) for i in os.getenv("ADMIN_IDS", "").split(",") if i.strip()}
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")  # sqlite | memory
+STATE_DB_PATH = os.getenv("STATE_DB_PATH", "bot_state.db")
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "2"))  # сек. между записями на диск
+STATE_MISS_TTL = float(os.getenv("STATE_MISS_TTL", "10"))  # сек., сколько помнить, что языка в хранилище нет
+USER_RATE_PER_MINUTE = float(os.getenv("USER_RATE_PER_MINUTE", "6"))  # вопросов к ИИ в минуту на пользователя
+USER_RATE_BURST = int(os.getenv("USER_RATE_BURST", "3"))
+LLM_QUEUE_SIZE = int(os.getenv("LLM_QUEUE_SIZE", "100"))  # запросов сверх LLM_MAX_CONCURRENCY в ожидании
+# Модели OpenRouter в порядке предпочтения: первая — основная, остальные — запасные
+LLM_MODELS = [m.strip() for m in os.getenv(
+    "LLM_MODELS", "meta-llama/llama-3-8b-instruct,mistralai/mistral-7b-instruct"
+).split(",") if m.strip()]
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY", "8"))  # сек. до запасного запроса, пока нет статистики
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "2"))
+CIRCUIT_FAILURES = int(os.getenv("CIRCUIT_FAILURES", "3"))  # ошибок подряд до отключения модели
+CIRCUIT_COOLDOWN = float(os.getenv("CIRCUIT_COOLDOWN", "60"))  # сек. отключения
 
 COLLEGE_NAME_RU = "Карагандинский колледж технологии и сервиса"
 COLLEGE_NAME_KZ = "Қарағанды технология және сервис колледжі КМҚК"
@@ -30,23 +95,286 @@ logger = logging.getLogger(__name__)
 bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
 dp = Dispatcher()
 
-# --- Кэш информации с сайта ---
-website_cache = {"last_update": None, "content": ""}
+# --- Метрики (формат Prometheus) ---
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
 
-# --- Функция для парсинга сайта колледжа ---
-def fetch_website_info():
-    """Получает информацию с официального сайта колледжа"""
-    try:
-        response = requests.get(SITE_URL, timeout=10)
-        if response.status_code == 200:
-            soup = BeautifulSoup(response.content, 'html.parser')
-            # Извлекаем текстовый контент (можно настроить под структуру сайта)
-            text_content = soup.get_text(separator=' ', strip=True)
-            return text_content[:3000]  # Ограничиваем размер
-        return ""
-    except Exception as e:
-        logger.error(f"Ошибка при парсинге сайта: {e}")
+def format_labels(labelnames: tuple, values: tuple) -> str:
+    if not labelnames:
         return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(labelnames, values))
+    return "{" + pairs + "}"
+
+class CounterMetric:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.values = {}
+
+    def inc(self, amount: float = 1, *labels):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        for labels, value in self.values.items():
+            lines.append(f"{self.name}{format_labels(self.labelnames, labels)} {value}")
+        return lines
+
+class HistogramMetric:
+    def __init__(self, name: str, documentation: str, labelnames: tuple = (), buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self.values = {}  # метки -> [счётчики по корзинам, сумма, количество]
+
+    def observe(self, value: float, *labels):
+        series = self.values.get(labels)
+        if series is None:
+            series = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series[0][i] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        for labels, (counts, total, count) in self.values.items():
+            for bound, bucket_count in zip(self.buckets, counts):
+                le = format_labels(self.labelnames + ("le",), labels + (bound,))
+                lines.append(f"{self.name}_bucket{le} {bucket_count}")
+            le = format_labels(self.labelnames + ("le",), labels + ("+Inf",))
+            lines.append(f"{self.name}_bucket{le} {count}")
+            lines.append(f"{self.name}_sum{format_labels(self.labelnames, labels)} {total}")
+            lines.append(f"{self.name}_count{format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+HANDLER_SECONDS = HistogramMetric("bot_handler_seconds", "Время работы обработчика", ("handler",))
+UPDATE_SECONDS = HistogramMetric("bot_update_seconds", "Время от приёма вебхука до конца обработки")
+LLM_SECONDS = HistogramMetric("bot_llm_request_seconds", "Длительность запроса к модели", ("model", "outcome"))
+LLM_TTFT_SECONDS = HistogramMetric("bot_llm_time_to_first_token_seconds", "Время до первого токена", ("model",))
+LLM_TOKENS = CounterMetric("bot_llm_tokens_total", "Токены по данным OpenRouter", ("model", "kind"))
+TELEGRAM_SECONDS = HistogramMetric("bot_telegram_request_seconds", "Задержка запросов к Telegram API", ("method",))
+FAQ_ANSWERS_TOTAL = CounterMetric("bot_faq_answers_total", "Ответы без ИИ по частым вопросам", ("intent",))
+
+def snapshot_lines(name: str, documentation: str, values: dict, labelnames: tuple, kind: str = "gauge") -> list[str]:
+    """Значения, которые считываются в момент запроса /metrics; ключи — кортежи меток.
+    Монотонные счётчики отдаются с kind="counter", чтобы к ним работал rate()."""
+    lines = [f"# HELP {name} {documentation}", f"# TYPE {name} {kind}"]
+    for labels, value in values.items():
+        if value is not None:
+            lines.append(f"{name}{format_labels(labelnames, labels)} {float(value)}")
+    return lines
+
+def stats_lines(name: str, documentation: str, stats: dict, counters: tuple) -> list[str]:
+    """Разводит stats() компонента: ключи из counters — в <name>_total{event=...}, остальные — в gauge <name>"""
+    lines = snapshot_lines(
+        name, documentation, {(key,): value for key, value in stats.items() if key not in counters}, ("stat",)
+    )
+    lines += snapshot_lines(
+        f"{name}_total", documentation, {(key,): stats[key] for key in counters}, ("event",), "counter"
+    )
+    return lines
+
+def render_metrics() -> str:
+    lines = []
+    for metric in (HANDLER_SECONDS, UPDATE_SECONDS, LLM_SECONDS, LLM_TTFT_SECONDS, LLM_TOKENS,
+                   TELEGRAM_SECONDS, FAQ_ANSWERS_TOTAL):
+        lines += metric.render()
+    lines += stats_lines(
+        "bot_answer_cache", "Кэш ответов: попадания, промахи, размер", answer_cache.stats(), ("hits", "misses")
+    )
+    lines += stats_lines(
+        "bot_llm_scheduler", "Планировщик запросов к ИИ: очередь, объединённые и отклонённые запросы",
+        llm_scheduler.stats(), ("coalesced", "shed", "rate_limited"),
+    )
+    lines += stats_lines(
+        "bot_outbound", "Очередь исходящих сообщений: в очереди, отправлено, повторы после 429, ошибки",
+        outbound.stats(), ("sent", "retried", "failed"),
+    )
+    router_stats = model_router.stats()
+    lines += snapshot_lines(
+        "bot_llm_router_total", "Хеджированные запросы и переходы на запасную модель",
+        {(key,): router_stats[key] for key in ("hedged", "fallbacks")}, ("event",), "counter",
+    )
+    lines += snapshot_lines(
+        "bot_llm_model", "Статистика моделей: задержки, доля ошибок, отключение",
+        {
+            (name, key): value
+            for name, model in model_router.models.items()
+            for key, value in model.stats().items()
+        },
+        ("model", "stat"),
+    )
+    return "\n".join(lines) + "\n"
+
+async def start_metrics_server() -> web.AppRunner | None:
+    if not METRICS_PORT:
+        return None
+
+    async def handle_metrics(request: web.Request) -> web.Response:
+        return web.Response(text=render_metrics(), content_type="text/plain", charset="utf-8")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, METRICS_PORT).start()
+    except OSError as e:
+        # Занятый порт не должен мешать боту отвечать
+        logger.error(f"Не удалось открыть /metrics на {METRICS_HOST}:{METRICS_PORT}: {e}")
+        await runner.cleanup()
+        return None
+    logger.info(f"📈 Метрики: http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+    return runner
+
+# --- Профилировщик медленных обновлений (по желанию) ---
+class SamplingProfiler:
+    """Фоновый поток периодически снимает стек главного потока. Для медленного
+    обновления в лог выводятся самые частые стеки за время его обработки."""
+
+    def __init__(self, interval: float, max_samples: int = 20000):
+        self.interval = interval
+        self.samples = deque(maxlen=max_samples)
+        self.main_thread_id = threading.main_thread().ident
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name="sampling-profiler", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            frame = sys._current_frames().get(self.main_thread_id)
+            if frame is not None:
+                stack = tuple(
+                    f"{os.path.basename(f.filename)}:{f.lineno} {f.name}"
+                    for f in traceback.extract_stack(frame)[-8:]
+                )
+                self.samples.append((time.perf_counter(), stack))
+            time.sleep(self.interval)
+
+    def dump(self, name: str, started: float, finished: float, top: int = 5):
+        stacks = Counter(stack for ts, stack in list(self.samples) if started <= ts <= finished)
+        if not stacks:
+            return
+        total = sum(stacks.values())
+        report = [f"🐢 Медленное обновление ({name}, {(finished - started) * 1000:.0f} мс), горячие стеки:"]
+        for stack, count in stacks.most_common(top):
+            report.append(f"  {count / total:.0%}: " + " <- ".join(reversed(stack)))
+        logger.warning("\n".join(report))
+
+profiler = SamplingProfiler(PROFILE_INTERVAL) if PROFILE_SLOW_UPDATE_MS > 0 else None
+
+# --- Middleware: время обработчиков и запросов к Telegram ---
+class HandlerTimingMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        name = handler_object.callback.__name__ if handler_object else "unknown"
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            finished = time.perf_counter()
+            HANDLER_SECONDS.observe(finished - started, name)
+            if profiler and (finished - started) * 1000 >= PROFILE_SLOW_UPDATE_MS:
+                profiler.dump(name, started, finished)
+
+class TelegramTimingMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, type(method).__name__)
+
+dp.message.middleware(HandlerTimingMiddleware())
+bot.session.middleware(TelegramTimingMiddleware())
+
+# --- Кэш информации с сайта ---
+website_cache = {"last_update": None, "content": "", "pages": {}}
+
+# --- Фоновый обход сайта колледжа ---
+def extract_page_text(content: bytes, encoding: str) -> str:
+    """Извлекает видимый текст страницы (lxml, вызывается вне event loop)"""
+    tree = lxml_html.fromstring(content, parser=lxml_html.HTMLParser(encoding=encoding))
+    for node in tree.xpath("//script|//style|//noscript"):
+        node.drop_tree()
+    text = " ".join(tree.text_content().split())
+    return text[:SITE_PAGE_MAX_CHARS]
+
+def get_site_urls() -> list[str]:
+    return [SITE_URL] + [urljoin(SITE_URL, page) for page in SITE_PAGES]
+
+async def fetch_page(client: httpx.AsyncClient, url: str, page: dict) -> bool:
+    """Загружает страницу с условными заголовками. Возвращает True, если текст изменился"""
+    headers = {}
+    if page.get("etag"):
+        headers["If-None-Match"] = page["etag"]
+    if page.get("last_modified"):
+        headers["If-Modified-Since"] = page["last_modified"]
+    
+    started = time.perf_counter()
+    response = await client.get(url, headers=headers)
+    page["fetch_ms"] = (time.perf_counter() - started) * 1000
+    page["status"] = response.status_code
+    page["checked_at"] = datetime.now()
+    if response.status_code == 304:
+        return False
+    response.raise_for_status()
+    
+    page["etag"] = response.headers.get("ETag")
+    page["last_modified"] = response.headers.get("Last-Modified")
+    digest = hashlib.sha256(response.content).hexdigest()
+    if digest == page.get("hash"):
+        return False
+    
+    started = time.perf_counter()
+    page["text"] = await asyncio.to_thread(
+        extract_page_text, response.content, response.encoding or "utf-8"
+    )
+    page["parse_ms"] = (time.perf_counter() - started) * 1000
+    page["hash"] = digest
+    page["changed_at"] = page["checked_at"]
+    return True
+
+async def crawl_site(client: httpx.AsyncClient):
+    """Один обход сайта; website_cache обновляется целиком только при изменениях"""
+    started = time.perf_counter()
+    pages = website_cache["pages"]
+    urls = get_site_urls()
+    changed = 0
+    for url in urls:
+        page = pages.setdefault(url, {})
+        try:
+            changed += await fetch_page(client, url, page)
+        except Exception as e:
+            page["error"] = str(e)
+            logger.error(f"Ошибка при загрузке {url}: {e}")
+        else:
+            page.pop("error", None)
+    
+    if changed:
+        content = "\n\n".join(pages[url]["text"] for url in urls if pages[url].get("text"))
+        # Контент и время обновления подменяются за один шаг, без await между ними
+        website_cache.update(content=content, last_update=datetime.now())
+        logger.info(f"📄 Информация с сайта обновлена: {changed} стр. изменилось")
+    logger.info(
+        f"🕸 Обход сайта: {len(urls)} стр., изменено {changed}, "
+        f"{(time.perf_counter() - started) * 1000:.0f} мс"
+    )
+
+async def crawl_site_forever():
+    """Фоновая задача: обходит сайт раз в CRAWL_INTERVAL секунд"""
+    async with httpx.AsyncClient(timeout=10, follow_redirects=True) as client:
+        while True:
+            try:
+                await crawl_site(client)
+            except Exception as e:
+                logger.error(f"Ошибка при обходе сайта: {e}")
+            await asyncio.sleep(CRAWL_INTERVAL)
 
 # --- База знаний колледжа ---
 COLLEGE_KNOWLEDGE_BASE_RU = """
@@ -130,11 +458,9 @@ COLLEGE_KNOWLEDGE_BASE_KZ = """
 """
 
 # --- Системные инструкции (Prompt для ИИ) ---
-def get_system_prompt(lang: str) -> str:
-    knowledge_base = COLLEGE_KNOWLEDGE_BASE_KZ if lang == "kz" else COLLEGE_KNOWLEDGE_BASE_RU
-    
-    if lang == "kz":
-        return f"""Сен — Қарағанды технология және сервис колледжінің виртуалды көмекшісісің.
+# Неизменные части промпта собираются один раз при запуске
+PROMPT_PREFIX = {
+    "kz": """Сен — Қарағанды технология және сервис колледжінің виртуалды көмекшісісің.
 
 МАҢЫЗДЫ ЕРЕЖЕЛЕР:
 1. Тек колледжге қатысты сұрақтарға жауап бер (оқу, қабылдау, сабақ кестесі, мамандықтар, байланыс, студенттік өмір)
@@ -143,14 +469,8 @@ def get_system_prompt(lang: str) -> str:
 4. Ақпарат болмаса, ойдан шығарма. «Бұл туралы нақты мәлімет жоқ, байланыс телефондары арқылы анықтауға болады» деп жауап бер
 
 РЕСМИ АҚПАРАТ:
-{knowledge_base}
-
-Ресми сайт: {SITE_URL}
-Сабақ кестесі: {SCHEDULE_URL}
-
-Жауаптарыңды қысқа, нақты және пайдалы етіп бер. Байланыс ақпаратын дұрыс көрсет."""
-    else:
-        return f"""Ты — виртуальный помощник Карагандинского колледжа технологии и сервиса (ККТиС).
+""",
+    "ru": """Ты — виртуальный помощник Карагандинского колледжа технологии и сервиса (ККТиС).
 
 ВАЖНЫЕ ПРАВИЛА:
 1. Отвечай ТОЛЬКО на вопросы о колледже (образование, приём, расписание, специальности, контакты, студенческая жизнь)
@@ -159,15 +479,170 @@ def get_system_prompt(lang: str) -> str:
 4. Не придумывай ответы! Если информации нет, скажи: «По этому вопросу нет точной информации, рекомендую уточнить по контактным телефонам»
 
 ОФИЦИАЛЬНАЯ ИНФОРМАЦИЯ:
-{knowledge_base}
+""",
+}
 
+PROMPT_SUFFIX = {
+    "kz": f"""
+Ресми сайт: {SITE_URL}
+Сабақ кестесі: {SCHEDULE_URL}
+
+Жауаптарыңды қысқа, нақты және пайдалы етіп бер. Байланыс ақпаратын дұрыс көрсет.""",
+    "ru": f"""
 Официальный сайт: {SITE_URL}
 Расписание занятий: {SCHEDULE_URL}
 
-Давай короткие, точные и полезные ответы. Всегда указывай правильные контактные данные."""
+Давай короткие, точные и полезные ответы. Всегда указывай правильные контактные данные.""",
+}
+
+def get_system_prompt(lang: str, question: str = None) -> str:
+    """Системный промпт: постоянные правила + только релевантные вопросу фрагменты базы знаний.
+
+    Без вопроса подставляется вся база знаний (как раньше).
+    """
+    lang = "kz" if lang == "kz" else "ru"
+    if question is None:
+        knowledge = COLLEGE_KNOWLEDGE_BASE_KZ if lang == "kz" else COLLEGE_KNOWLEDGE_BASE_RU
+    else:
+        knowledge = "\n\n".join(retrieve_chunks(question, lang))
+    return PROMPT_PREFIX[lang] + knowledge + "\n" + PROMPT_SUFFIX[lang]
 
 # --- Состояние языка ---
-user_lang = {}
+class MemoryStateBackend:
+    """Хранилище в памяти процесса (для тестов и разработки)"""
+
+    def __init__(self):
+        self.data = {}
+
+    def load(self, user_id: int) -> str | None:
+        return self.data.get(user_id)
+
+    def load_all(self) -> dict:
+        return dict(self.data)
+
+    def save_many(self, items: dict):
+        self.data.update(items)
+
+    def close(self):
+        pass
+
+class SqliteStateBackend:
+    """Хранилище в SQLite (WAL): переживает перезапуски, доступно нескольким процессам"""
+
+    def __init__(self, path: str):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS user_lang (user_id INTEGER PRIMARY KEY, lang TEXT NOT NULL)"
+        )
+        self.conn.commit()
+
+    def load(self, user_id: int) -> str | None:
+        with self.lock:
+            row = self.conn.execute("SELECT lang FROM user_lang WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def load_all(self) -> dict:
+        with self.lock:
+            return dict(self.conn.execute("SELECT user_id, lang FROM user_lang"))
+
+    def save_many(self, items: dict):
+        with self.lock:
+            with self.conn:
+                self.conn.executemany(
+                    "INSERT INTO user_lang (user_id, lang) VALUES (?, ?) "
+                    "ON CONFLICT(user_id) DO UPDATE SET lang = excluded.lang",
+                    items.items(),
+                )
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+class UserLangStore:
+    """Язык пользователей: словарь в памяти поверх хранилища.
+
+    Чтение — O(1) из словаря; при промахе хранилище читается в отдельном потоке,
+    а отсутствие записи помнится STATE_MISS_TTL секунд, чтобы увидеть язык,
+    сохранённый позже другим процессом. Запись — в словарь сразу, на диск
+    пачками в фоне (write-behind).
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.cache = {}
+        self.dirty = {}
+        self.missing = {}  # user_id -> monotonic-время, до которого не перечитываем хранилище
+
+    def warm_up(self):
+        self.cache.update(self.backend.load_all())
+        logger.info(f"👥 Загружено пользователей: {len(self.cache)}")
+
+    async def get(self, user_id: int, default: str = None) -> str | None:
+        try:
+            return self.cache[user_id]
+        except KeyError:
+            pass
+        expires = self.missing.get(user_id)
+        if expires is not None:
+            if expires > time.monotonic():
+                return default
+            del self.missing[user_id]
+        lang = await asyncio.to_thread(self.backend.load, user_id)
+        if lang is None:
+            now = time.monotonic()
+            if len(self.missing) >= 10000:
+                self.prune_missing(now)
+            self.missing[user_id] = now + STATE_MISS_TTL
+            return default
+        self.missing.pop(user_id, None)
+        # Пока читали, пользователь мог выбрать язык — он свежее
+        return self.cache.setdefault(user_id, sys.intern(lang))
+
+    def prune_missing(self, now: float):
+        """Удаляет истёкшие отметки: в словаре остаются только промахи последних STATE_MISS_TTL секунд"""
+        for user_id in [u for u, expires in self.missing.items() if expires <= now]:
+            del self.missing[user_id]
+
+    def __getitem__(self, user_id: int) -> str:
+        """Только из памяти, без обращения к хранилищу"""
+        return self.cache[user_id]
+
+    def __setitem__(self, user_id: int, lang: str):
+        # "ru"/"kz" — интернированные строки, значения словаря не дублируются в памяти
+        lang = sys.intern(lang)
+        self.cache[user_id] = lang
+        self.dirty[user_id] = lang
+        self.missing.pop(user_id, None)
+
+    def items(self):
+        return list(self.cache.items())
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        items, self.dirty = self.dirty, {}
+        try:
+            await asyncio.to_thread(self.backend.save_many, items)
+        except Exception as e:
+            # Возвращаем несохранённое, не затирая более свежие изменения
+            self.dirty = {**items, **self.dirty}
+            logger.error(f"Ошибка при сохранении языков пользователей: {e}")
+
+    async def run_flusher(self):
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL)
+            await self.flush()
+
+def create_state_backend():
+    if STATE_BACKEND == "memory":
+        return MemoryStateBackend()
+    return SqliteStateBackend(STATE_DB_PATH)
+
+# Настоящее хранилище подключается в main(); до этого (тесты, скрипты) — память
+user_lang = UserLangStore(MemoryStateBackend())
 
 # --- Главная клавиатура ---
 def get_main_keyboard(lang: str) -> ReplyKeyboardMarkup:
@@ -193,42 +668,1236 @@ def get_back_keyboard(lang: str) -> ReplyKeyboardMarkup:
         button = KeyboardButton(text="🔙 Назад")
     return ReplyKeyboardMarkup(keyboard=[[button]], resize_keyboard=True)
 
-# --- Генерация ответа через OpenRouter ---
-async def generate_reply(prompt: str, lang: str) -> str:
-    try:
-        headers = {
+# --- Тексты разделов меню ---
+def get_schedule_text(lang: str) -> str:
+    return (
+        f"📅 <b>Сабақ кестесі</b>\n\n🔗 <a href='{SCHEDULE_URL}'>Кестені ашу</a>\n\n🌐 {SITE_URL}"
+        if lang == "kz"
+        else f"📅 <b>Расписание занятий</b>\n\n🔗 <a href='{SCHEDULE_URL}'>Открыть расписание</a>\n\n🌐 {SITE_URL}"
+    )
+
+def get_contacts_text(lang: str) -> str:
+    return (
+        "📞 <b>Байланыс:</b>\n📍 Қарағанды, Затаевич к., 75\n☎️ 8-7212-37-58-44\n✉️ krg-koll-7092@bilim09.kz\n🌐 https://kktis.kz/"
+        if lang == "kz"
+        else "📞 <b>Контакты:</b>\n📍 Караганда, ул. Затаевича, 75\n☎️ 8-7212-37-58-44\n✉️ krg-koll-7092@bilim09.kz\n🌐 https://kktis.kz/"
+    )
+
+def get_admission_text(lang: str) -> str:
+    return (
+        "🎓 <b>ҚАБЫЛДАУ КОМИССИЯСЫ</b>\n\nҚарағанды технология және сервис колледжі келесі мамандықтар бойынша оқуға шақырады:\n\n"
+        "💻 Цифрлық техника — 11 сынып негізінде, 10 ай\n✂️ Шаштараз өнері — 9 сынып негізінде, 2 жыл 10 ай\n"
+        "👗 Киім өндірісі және үлгілеу — 9 сынып негізінде, 2 жыл 10 ай\n🧵 Тігінші — 9 сынып негізінде, 2 жыл 10 ай\n"
+        "👞 Аяқ киім ісі — ТиПО негізінде, 10 ай\n💼 Офис-менеджер — 11 сынып негізінде, 10 ай\n\n"
+        "📋 Қажетті құжаттар:\n1️⃣ Өтініш\n2️⃣ Білім туралы құжат\n3️⃣ 3x4 фото (4 дана)\n4️⃣ 075У мед. анықтама\n\n"
+        "📍 Мекенжайы: Қарағанды қ., Затаевич к., 75\n"
+        "📞 Әмірханова М.А. — 8-701-842-25-36\n📞 Искакова Г.К. — 8-700-145-45-36\n⏰ Дс–Жм: 08:00–17:00"
+        if lang == "kz"
+        else
+        "🎓 <b>ПРИЁМНАЯ КОМИССИЯ</b>\n\nКарагандинский колледж технологии и сервиса приглашает абитуриентов:\n\n"
+        "💻 Цифровая техника — 11 кл., 10 мес.\n✂️ Парикмахерское искусство — 9 кл., 2 г. 10 мес.\n"
+        "👗 Швейное производство и моделирование одежды — 9 кл., 2 г. 10 мес.\n🧵 Портной — 9 кл., 2 г. 10 мес.\n"
+        "👞 Обувное дело — 10 мес.\n💼 Офис-менеджер — 11 кл., 10 мес.\n\n"
+        "📋 Документы:\n1️⃣ Заявление\n2️⃣ Документ об образовании\n3️⃣ Фото 3×4 (4 шт.)\n4️⃣ Медсправка 075У\n\n"
+        "📍 Адрес: Караганда, ул. Затаевича, 75\n📞 Әмірханова М.А. — 8-701-842-25-36\n📞 Искакова Г.К. — 8-700-145-45-36\n⏰ Пн–Пт: 08:00–17:00"
+    )
+
+def get_bell_schedule_text(lang: str) -> str:
+    if lang == "kz":
+        return (
+            "<b>⏰ Қоңырау кестесі</b>\n\n<b>Дүйсенбі:</b>\nКураторлық сағат — 09:00 – 09:45\n"
+            "Үзіліс — 5 мин\n1-пара — 09:50 – 11:20\n\nТүскі ас (1-ағын) — 20 мин\n2-пара — 11:40 – 13:10\n\n"
+            "Түскі ас (2-ағын) — 20 мин\n3-пара — 13:30 – 15:00\n\n——————————————\n<b>Сейсенбі – Жұма:</b>\n"
+            "1-пара — 09:00 – 10:30\nҮзіліс — 10 мин\n2-пара — 10:40 – 12:10\n\nТүскі ас (1-ағын) — 20 мин\n"
+            "3-пара — 12:30 – 14:00\n\nТүскі ас (2-ағын) — 20 мин\n4-пара — 14:20 – 15:50"
+        )
+    else:
+        return (
+            "<b>⏰ Расписание звонков</b>\n\n<b>Понедельник:</b>\nКураторский час — 09:00 – 09:45\n"
+            "Перемена — 5 мин\n1 пара — 09:50 – 11:20\n\nОбед (1-й поток) — 20 мин\n2 пара — 11:40 – 13:10\n\n"
+            "Обед (2-й поток) — 20 мин\n3 пара — 13:30 – 15:00\n\n——————————————\n<b>Вторник – Пятница:</b>\n"
+            "1 пара — 09:00 – 10:30\nПеремена — 10 мин\n2 пара — 10:40 – 12:10\n\nОбед (1-й поток) — 20 мин\n"
+            "3 пара — 12:30 – 14:00\n\nОбед (2-й поток) — 20 мин\n4 пара — 14:20 – 15:50"
+        )
+
+# --- Нормализация вопросов ---
+# Казахские буквы часто набирают русскими «двойниками», ё — как е
+LETTER_VARIANTS = str.maketrans({
+    "ё": "е", "ә": "а", "ғ": "г", "қ": "к", "ң": "н",
+    "ө": "о", "ұ": "у", "ү": "у", "һ": "х", "і": "и",
+})
+PUNCTUATION_RE = re.compile(r"[^\w\s]+")
+WHITESPACE_RE = re.compile(r"\s+")
+
+def normalize_question(text: str) -> str:
+    """Приводит вопрос к каноническому виду: регистр, пунктуация, пробелы, варианты букв"""
+    text = (text or "").lower().translate(LETTER_VARIANTS)
+    text = PUNCTUATION_RE.sub(" ", text).replace("_", " ")
+    return WHITESPACE_RE.sub(" ", text).strip()
+
+# --- Локальный классификатор частых вопросов (без обращения к ИИ) ---
+FAQ_MATCH_THRESHOLD = float(os.getenv("FAQ_MATCH_THRESHOLD", "0.75"))  # доля покрытых слов вопроса
+FAQ_WORD_SIMILARITY = float(os.getenv("FAQ_WORD_SIMILARITY", "0.5"))  # с какой близости слово считается знакомым
+FAQ_MATCH_MARGIN = float(os.getenv("FAQ_MATCH_MARGIN", "0.15"))  # на сколько покрытие должно опережать второй раздел
+
+# Примеры формулировок для каждого раздела (RU и KZ вперемешку)
+FAQ_INTENTS = {
+    "contacts": [
+        "контакты колледжа", "адрес колледжа", "где находится колледж", "какой адрес",
+        "номер телефона колледжа", "как позвонить в колледж", "телефон колледжа",
+        "электронная почта колледжа", "email колледжа", "как с вами связаться",
+        "колледждің мекенжайы", "колледж қайда орналасқан", "байланыс телефоны",
+        "колледждің телефон нөмірі", "электрондық пошта", "сіздермен қалай байланысуға болады",
+        "как вас найти где находитесь",
+    ],
+    "admission": [
+        "приёмная комиссия", "какие документы нужны для поступления", "какие документы нужны",
+        "как поступить в колледж", "какие есть специальности", "список специальностей",
+        "на какие специальности можно поступить", "сколько лет учиться", "сколько длится учёба",
+        "поступление после 9 класса", "поступление после 11 класса", "телефон приёмной комиссии",
+        "график работы приёмной комиссии",
+        "қабылдау комиссиясы", "қандай құжаттар керек", "түсу үшін қандай құжаттар қажет",
+        "колледжге қалай түсуге болады", "қандай мамандықтар бар", "мамандықтар тізімі",
+        "неше жыл оқимыз", "9 сыныптан кейін түсу", "11 сыныптан кейін түсу",
+        "қабылдау комиссиясының телефоны",
+        "учиться на парикмахера", "учиться на портного", "учиться на офис менеджера",
+        "цифровая техника", "швейное производство", "обувное дело",
+    ],
+    "bell_schedule": [
+        "расписание звонков", "когда звонок", "во сколько начинается первая пара",
+        "во сколько заканчиваются пары", "время пар", "когда перемена", "когда обед",
+        "во сколько начинаются занятия", "кураторский час",
+        "қоңырау кестесі", "қоңырау қашан", "бірінші пара қашан басталады",
+        "сабақ қашан аяқталады", "үзіліс қашан", "түскі ас қашан", "кураторлық сағат",
+        "обед первого и второго потока", "сколько минут перемена", "звонки в понедельник и вторник",
+        "пара нешеде басталады", "үзіліс неше минут",
+    ],
+    "schedule": [
+        "расписание занятий", "где посмотреть расписание", "расписание уроков",
+        "ссылка на расписание", "расписание пар", "покажи расписание",
+        "сабақ кестесі", "сабақ кестесін қайдан көруге болады", "кесте сілтемесі",
+    ],
+}
+
+FAQ_ANSWERS = {
+    "contacts": get_contacts_text,
+    "admission": get_admission_text,
+    "bell_schedule": get_bell_schedule_text,
+    "schedule": get_schedule_text,
+}
+
+# Служебные слова не отличают один раздел от другого (формы уже нормализованы)
+FAQ_STOP_WORDS = {
+    "а", "в", "во", "и", "к", "на", "по", "с", "у", "о", "ли", "же", "вас", "вы", "мне", "нам", "для",
+    "дайте", "скажите", "подскажите", "скиньте", "покажи", "покажите", "пожалуйста", "нужно", "надо",
+    "как", "какой", "какая", "какие", "где", "когда", "кто", "что", "сколько", "есть", "можно",
+    "колледж", "колледжа", "колледже", "колледжу", "колледжем",
+    "бар", "ма", "ме", "ба", "бе", "па", "пе", "кандай", "калай", "кайда", "кашан", "канша", "не",
+    "колледжде", "колледждин", "колледжге", "колледжды",
+}
+
+def content_words(text: str) -> list[str]:
+    """Значимые слова нормализованного текста (без служебных)"""
+    return [word for word in normalize_question(text).split() if word not in FAQ_STOP_WORDS]
+
+def char_ngrams(word: str, n_min: int = 3, n_max: int = 4) -> dict:
+    """Символьные n-граммы слова — сглаживают окончания («телефон», «телефона»)"""
+    grams = {}
+    word = f" {word} "
+    for n in range(n_min, n_max + 1):
+        for i in range(len(word) - n + 1):
+            gram = word[i:i + n]
+            grams[gram] = grams.get(gram, 0) + 1
+    return grams
+
+class FaqMatcher:
+    """Оценивает, какую долю значимых слов вопроса покрывает словарь раздела.
+
+    Слово вопроса засчитывается разделу по лучшей близости (TF-IDF по символьным
+    n-граммам) к какому-либо слову из его примеров, если она не ниже FAQ_WORD_SIMILARITY.
+    Одного общего слова мало: «телефон бухгалтерии» покрыт только наполовину.
+    """
+
+    def __init__(self, intents: dict):
+        vocabulary = {}  # слово -> разделы, в примерах которых оно встречается
+        for intent, phrases in intents.items():
+            for phrase in phrases:
+                for word in content_words(phrase):
+                    vocabulary.setdefault(word, set()).add(intent)
+        self.words = list(vocabulary)
+        self.word_intents = [vocabulary[word] for word in self.words]
+        doc_freq = {}
+        for word in self.words:
+            for gram in char_ngrams(word):
+                doc_freq[gram] = doc_freq.get(gram, 0) + 1
+        total = len(self.words)
+        self.idf = {gram: math.log((1 + total) / (1 + df)) + 1 for gram, df in doc_freq.items()}
+        # Обратный индекс: n-грамма -> [(номер слова словаря, вес)]
+        self.index = {}
+        for i, word in enumerate(self.words):
+            for gram, weight in self.vectorize(word).items():
+                self.index.setdefault(gram, []).append((i, weight))
+        self.intents = list(intents)
+
+    def vectorize(self, word: str) -> dict:
+        grams = char_ngrams(word)
+        vector = {gram: count * self.idf[gram] for gram, count in grams.items() if gram in self.idf}
+        # Норма считается и по незнакомым n-граммам, иначе чужое слово выглядело бы похожим
+        unknown = sum(count for gram, count in grams.items() if gram not in self.idf)
+        norm = math.sqrt(sum(w * w for w in vector.values()) + unknown * max(self.idf.values(), default=1) ** 2)
+        return {gram: w / norm for gram, w in vector.items()} if norm else {}
+
+    def word_scores(self, word: str) -> dict:
+        """Лучшая близость слова к словарю каждого раздела"""
+        similarities = {}
+        for gram, weight in self.vectorize(word).items():
+            for i, word_weight in self.index.get(gram, ()):
+                similarities[i] = similarities.get(i, 0.0) + weight * word_weight
+        best = {}
+        for i, similarity in similarities.items():
+            if similarity < FAQ_WORD_SIMILARITY:
+                continue
+            for intent in self.word_intents[i]:
+                best[intent] = max(best.get(intent, 0.0), similarity)
+        return best
+
+    def score(self, text: str) -> tuple[str | None, float, float]:
+        """Возвращает (раздел, покрытие значимых слов вопроса от 0 до 1, отрыв от второго раздела)"""
+        words = content_words(text)
+        if not words:
+            return None, 0.0, 0.0
+        coverage = dict.fromkeys(self.intents, 0.0)
+        for word in words:
+            for intent, similarity in self.word_scores(word).items():
+                coverage[intent] += similarity
+        best, runner_up = sorted(coverage, key=coverage.get, reverse=True)[:2]
+        margin = (coverage[best] - coverage[runner_up]) / len(words)
+        return (best if coverage[best] else None), coverage[best] / len(words), margin
+
+    def match(self, text: str, threshold: float = None) -> str | None:
+        intent, score, margin = self.score(text)
+        if threshold is None:
+            threshold = FAQ_MATCH_THRESHOLD
+        # «расписание» или «телефон» одинаково подходят двум разделам — пусть отвечает ИИ
+        return intent if score >= threshold and margin >= FAQ_MATCH_MARGIN else None
+
+faq_matcher = FaqMatcher(FAQ_INTENTS)
+
+def get_faq_answer(text: str, lang: str) -> str | None:
+    """Готовый ответ из разделов меню, если вопрос уверенно распознан"""
+    intent = faq_matcher.match(text)
+    if intent is None:
+        return None
+    FAQ_ANSWERS_TOTAL.inc(1, intent)
+    return FAQ_ANSWERS[intent](lang)
+
+# --- Расписание занятий по группам ---
+# Время пар по расписанию звонков: понедельник (0 — кураторский час) и вторник–пятница
+BELL_TIMES_MONDAY = {0: ("09:00", "09:45"), 1: ("09:50", "11:20"), 2: ("11:40", "13:10"), 3: ("13:30", "15:00")}
+BELL_TIMES_WEEK = {1: ("09:00", "10:30"), 2: ("10:40", "12:10"), 3: ("12:30", "14:00"), 4: ("14:20", "15:50")}
+
+WEEKDAY_NAMES = {
+    "ru": ["Понедельник", "Вторник", "Среда", "Четверг", "Пятница", "Суббота", "Воскресенье"],
+    "kz": ["Дүйсенбі", "Сейсенбі", "Сәрсенбі", "Бейсенбі", "Жұма", "Сенбі", "Жексенбі"],
+}
+# Основы названий дней после normalize_question (казахские буквы уже заменены)
+WEEKDAY_STEMS = (
+    ("понедельн", 0), ("вторник", 1), ("сред", 2), ("четверг", 3), ("пятниц", 4), ("суббот", 5),
+    ("дуйсенб", 0), ("сейсенб", 1), ("сарсенб", 2), ("бейсенб", 3), ("жума", 4), ("сенби", 5),
+)
+WEEKDAY_ABBREVIATIONS = {"пн": 0, "вт": 1, "ср": 2, "чт": 3, "пт": 4, "сб": 5, "дс": 0, "сс": 1, "бс": 3, "жм": 4}
+RELATIVE_DAYS = {"сегодня": 0, "бугин": 0, "завтра": 1, "ертен": 1}
+DAY_HEADERS = ("день", "кун")
+PAIR_HEADERS = ("пара", "n", "номер")
+GROUP_NAME_RE = re.compile(r"^[A-Za-zА-Яа-яЁёӘәҒғҚқҢңӨөҰұҮүҺһІі]{1,5}\s*-?\s*\d{1,3}[A-Za-zА-Яа-я]?$")
+# Слова, по которым понятно, что о группе спрашивают именно расписание
+SCHEDULE_CUE_WORDS = {"пара", "пары", "пар", "пару", "парой", "парам", "парах", "парасы", "сабак", "сабагы", "сабактар"}
+SCHEDULE_CUE_STEMS = ("расписан", "кесте", "занят", "урок")
+COLLEGE_TZ = timezone(timedelta(hours=int(os.getenv("COLLEGE_UTC_OFFSET", "5"))))
+
+def bell_time(weekday: int, pair: int) -> tuple[str, str] | None:
+    return (BELL_TIMES_MONDAY if weekday == 0 else BELL_TIMES_WEEK).get(pair)
+
+def group_key(name: str) -> str:
+    """«ЦТ-21», «цт 21» и «ЦТ21» дают один ключ"""
+    return normalize_question(name).replace(" ", "")
+
+def parse_weekday(text: str) -> int | None:
+    for word in normalize_question(text).split():
+        if word in WEEKDAY_ABBREVIATIONS:
+            return WEEKDAY_ABBREVIATIONS[word]
+        if word in RELATIVE_DAYS:
+            return (datetime.now(COLLEGE_TZ).weekday() + RELATIVE_DAYS[word]) % 7
+        for stem, weekday in WEEKDAY_STEMS:
+            if word.startswith(stem):
+                return weekday
+    return None
+
+def parse_pair(text: str) -> int | None:
+    digits = re.search(r"\d+", text or "")
+    return int(digits.group()) if digits else None
+
+class ScheduleIndex:
+    """Расписание: ключ группы -> день недели -> номер пары -> занятие"""
+
+    def __init__(self):
+        self.groups = {}  # ключ -> (название как в таблице, {день: {пара: занятие}})
+
+    def add(self, group: str, weekday: int, pair: int, lesson: str):
+        lesson = " ".join(lesson.split())
+        if not lesson:
+            return
+        _, days = self.groups.setdefault(group_key(group), (group.strip(), {}))
+        pairs = days.setdefault(weekday, {})
+        pairs[pair] = f"{pairs[pair]}; {lesson}" if pair in pairs else lesson
+
+    def find_group(self, text: str) -> tuple[str, str] | None:
+        """Ищет в тексте название известной группы (одно слово или «ЦТ 21» из двух).
+        Возвращает ключ группы и нормализованный текст без её названия."""
+        words = normalize_question(text).split()
+        for i, word in enumerate(words):
+            for size, candidate in ((1, word), (2, word + words[i + 1] if i + 1 < len(words) else None)):
+                if candidate in self.groups:
+                    return candidate, " ".join(words[:i] + words[i + size:])
+        return None
+
+    def lessons(self, key: str, weekday: int) -> dict:
+        return self.groups[key][1].get(weekday, {})
+
+def rows_to_schedule(rows: list[list[str]]) -> ScheduleIndex:
+    """Разбирает таблицу в одном из двух видов:
+    - «длинный»: столбцы Группа | День | Пара | Занятие (+ любые дополнительные);
+    - «широкий»: День | Пара | <группа 1> | <группа 2> ..., день может быть указан только в первой строке.
+    """
+    index = ScheduleIndex()
+    for header_row, header in enumerate(rows):
+        names = [normalize_question(cell) for cell in header]
+        group_columns = [i for i, cell in enumerate(header) if GROUP_NAME_RE.match(cell.strip())]
+        has_group_column = any(name.startswith(("групп", "топ")) for name in names)
+        has_day_or_pair = any(name.startswith(DAY_HEADERS + PAIR_HEADERS) for name in names)
+        # Заголовки вроде «Курс 1» или «Неделя 2» тоже похожи на группу: шапкой считаем
+        # строку со столбцами дня/пары или хотя бы с двумя группами
+        if (group_columns or has_group_column) and has_day_or_pair or len(group_columns) >= 2:
+            break
+    else:
+        return index
+
+    def column(*prefixes, default=None):
+        return next((i for i, name in enumerate(names) if name.startswith(prefixes)), default)
+
+    day_column = column(*DAY_HEADERS, default=0)
+    pair_column = column(*PAIR_HEADERS, default=1)
+    body = rows[header_row + 1:]
+
+    if has_group_column and not group_columns:
+        group_column = column("групп", "топ")
+        extra = [i for i in range(len(header)) if i not in (group_column, day_column, pair_column)]
+        required = max(group_column, day_column, pair_column) + 1
+        for row in body:
+            # Итоговые строки и заголовки с colspan короче шапки
+            if len(row) < required:
+                continue
+            weekday, pair = parse_weekday(row[day_column]), parse_pair(row[pair_column])
+            if weekday is None or pair is None:
+                continue
+            index.add(row[group_column], weekday, pair, ", ".join(row[i] for i in extra if i < len(row) and row[i].strip()))
+        return index
+
+    weekday = None
+    for row in body:
+        if day_column < len(row) and row[day_column].strip():
+            weekday = parse_weekday(row[day_column])
+        pair = parse_pair(row[pair_column]) if pair_column < len(row) else None
+        if weekday is None or pair is None:
+            continue
+        for i in group_columns:
+            if i < len(row):
+                index.add(header[i], weekday, pair, row[i])
+    return index
+
+def parse_schedule_csv(content: bytes) -> ScheduleIndex:
+    text = content.decode("utf-8-sig", errors="replace")
+    return rows_to_schedule(list(csv.reader(io.StringIO(text))))
+
+def parse_schedule_html(content: bytes) -> ScheduleIndex:
+    tree = lxml_html.fromstring(content, parser=lxml_html.HTMLParser(encoding="utf-8"))
+    rows = [
+        [" ".join(cell.text_content().split()) for cell in tr.xpath("./td|./th")]
+        for tr in tree.xpath("//table//tr")
+    ]
+    return rows_to_schedule(rows)
+
+def get_schedule_source_url() -> str | None:
+    """Google Таблицу скачиваем как CSV, остальные ссылки — как HTML"""
+    if SCHEDULE_SOURCE_URL:
+        return SCHEDULE_SOURCE_URL
+    if not SCHEDULE_URL:
+        return None
+    sheet = re.search(r"docs\.google\.com/spreadsheets/d/([\w-]+)", SCHEDULE_URL)
+    if sheet:
+        return f"https://docs.google.com/spreadsheets/d/{sheet.group(1)}/export?format=csv"
+    return SCHEDULE_URL
+
+schedule_index = ScheduleIndex()
+schedule_state = {"last_update": None, "hash": None}
+
+async def refresh_schedule(client: httpx.AsyncClient):
+    global schedule_index
+    url = get_schedule_source_url()
+    if not url:
+        return
+    response = await client.get(url)
+    response.raise_for_status()
+    digest = hashlib.sha256(response.content).hexdigest()
+    if digest == schedule_state["hash"]:
+        return
+    is_csv = "csv" in response.headers.get("Content-Type", "") or "format=csv" in url
+    parser = parse_schedule_csv if is_csv else parse_schedule_html
+    index = await asyncio.to_thread(parser, response.content)
+    # Новый индекс подменяет старый целиком
+    schedule_index = index
+    schedule_state.update(last_update=datetime.now(), hash=digest)
+    logger.info(f"🗓 Расписание обновлено: групп {len(index.groups)}")
+
+async def refresh_schedule_forever():
+    async with httpx.AsyncClient(timeout=20, follow_redirects=True) as client:
+        while True:
+            try:
+                await refresh_schedule(client)
+            except Exception as e:
+                logger.error(f"Ошибка при загрузке расписания: {e}")
+            await asyncio.sleep(SCHEDULE_REFRESH_INTERVAL)
+
+def format_day_schedule(key: str, weekday: int, lang: str, pair: int = None) -> str:
+    lessons = schedule_index.lessons(key, weekday)
+    if pair is not None:
+        lessons = {pair: lessons[pair]} if pair in lessons else {}
+    lines = [f"<b>{WEEKDAY_NAMES[lang][weekday]}</b>"]
+    if not lessons:
+        lines.append("Сабақ жоқ" if lang == "kz" else "Занятий нет")
+    for number in sorted(lessons):
+        label = f"{number}-пара" if lang == "kz" else f"{number} пара"
+        times = bell_time(weekday, number)
+        if times:
+            label += f" ({times[0]}–{times[1]})"
+        lines.append(f"{label}: {html.escape(lessons[number])}")
+    return "\n".join(lines)
+
+def has_schedule_cue(text: str) -> bool:
+    """День недели («среда», «завтра») или слова «пара», «расписание», «кесте» и т.п."""
+    if parse_weekday(text) is not None:
+        return True
+    return any(word in SCHEDULE_CUE_WORDS or word.startswith(SCHEDULE_CUE_STEMS) for word in text.split())
+
+def get_group_schedule_answer(text: str, lang: str, require_cue: bool = False) -> str | None:
+    """Ответ по расписанию группы, если в тексте есть известная группа; иначе None.
+
+    С require_cue (свободный вопрос в чате) отвечаем, только если спрашивают о расписании:
+    «кто куратор ЦТ-21?» должен уйти дальше, к частым вопросам и ИИ.
+    """
+    found = schedule_index.find_group(text or "")
+    if found is None:
+        return None
+    key, rest = found
+    if require_cue and not has_schedule_cue(rest):
+        return None
+    name = schedule_index.groups[key][0]
+    weekday = parse_weekday(rest)
+    pair = None
+    # Цифры из названия группы («ЦТ-21 пары») номером пары не считаются
+    pair_match = re.search(r"(?<!\d)(\d)\s*-?\s*пар", rest)
+    if pair_match:
+        pair = int(pair_match.group(1))
+    days = [weekday] if weekday is not None else sorted(schedule_index.groups[key][1])
+    header = f"📅 <b>{html.escape(name)}</b>"
+    return "\n\n".join([header] + [format_day_schedule(key, day, lang, pair) for day in days])
+
+# --- Кэш ответов ИИ (LRU + TTL) ---
+def knowledge_version() -> int:
+    """Отпечаток базы знаний и контента сайта: при их изменении кэш ответов сбрасывается"""
+    return hash((COLLEGE_KNOWLEDGE_BASE_RU, COLLEGE_KNOWLEDGE_BASE_KZ, website_cache["content"]))
+
+class AnswerCache:
+    """Кэш ответов по ключу (язык, нормализованный вопрос)"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.items = OrderedDict()
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+
+    def check_version(self):
+        version = knowledge_version()
+        if version != self.version:
+            if self.items:
+                logger.info("🧹 База знаний изменилась — кэш ответов очищен")
+            self.items.clear()
+            self.version = version
+
+    def get(self, lang: str, question: str) -> str | None:
+        self.check_version()
+        key = (lang, normalize_question(question))
+        item = self.items.get(key)
+        if item is None or item[0] < time.monotonic():
+            if item is not None:
+                del self.items[key]
+            self.misses += 1
+            return None
+        self.items.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def put(self, lang: str, question: str, answer: str):
+        self.check_version()
+        key = (lang, normalize_question(question))
+        if not key[1]:
+            return
+        self.items[key] = (time.monotonic() + self.ttl, answer)
+        self.items.move_to_end(key)
+        while len(self.items) > self.max_size:
+            self.items.popitem(last=False)
+
+    def clear(self):
+        self.items.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "size": len(self.items),
+        }
+
+answer_cache = AnswerCache(ANSWER_CACHE_SIZE, ANSWER_CACHE_TTL)
+
+# --- Поиск релевантных фрагментов базы знаний (BM25) ---
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "3"))
+SITE_CHUNK_SIZE = 600  # символов
+
+def retrieval_terms(text: str) -> list[str]:
+    """Термы для поиска: нормализованные значимые слова, усечённые до основы из 5 букв"""
+    return [word[:5] for word in normalize_question(text).split() if word not in FAQ_STOP_WORDS]
+
+def split_knowledge_base(text: str) -> list[str]:
+    """Делит базу знаний на разделы по пустым строкам; блоки без заголовка приклеиваются к предыдущему"""
+    chunks = []
+    for block in text.strip().split("\n\n"):
+        block = block.strip()
+        if not block:
+            continue
+        first_line = block.split("\n", 1)[0]
+        if chunks and not (first_line.endswith(":") and first_line.isupper()):
+            chunks[-1] += "\n\n" + block
+        else:
+            chunks.append(block)
+    return chunks
+
+def split_site_content(text: str) -> list[str]:
+    """Режет текст сайта на куски примерно по SITE_CHUNK_SIZE символов по границам слов"""
+    chunks, current, size = [], [], 0
+    for word in text.split():
+        current.append(word)
+        size += len(word) + 1
+        if size >= SITE_CHUNK_SIZE:
+            chunks.append(" ".join(current))
+            current, size = [], 0
+    if current:
+        chunks.append(" ".join(current))
+    return chunks
+
+class Bm25Index:
+    """Простой in-memory индекс BM25 по списку текстовых фрагментов"""
+
+    def __init__(self, chunks: list[str], k1: float = 1.5, b: float = 0.75):
+        self.chunks = chunks
+        self.k1 = k1
+        self.b = b
+        self.postings = {}  # терм -> [(номер фрагмента, частота)]
+        self.lengths = []
+        for i, chunk in enumerate(chunks):
+            terms = retrieval_terms(chunk)
+            self.lengths.append(len(terms))
+            counts = {}
+            for term in terms:
+                counts[term] = counts.get(term, 0) + 1
+            for term, count in counts.items():
+                self.postings.setdefault(term, []).append((i, count))
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        total = len(chunks)
+        self.idf = {
+            term: math.log(1 + (total - len(docs) + 0.5) / (len(docs) + 0.5))
+            for term, docs in self.postings.items()
+        }
+
+    def search(self, text: str, top_k: int) -> list[int]:
+        scores = {}
+        for term in set(retrieval_terms(text)):
+            idf = self.idf.get(term)
+            if idf is None:
+                continue
+            for i, count in self.postings[term]:
+                norm = self.k1 * (1 - self.b + self.b * self.lengths[i] / self.avg_length)
+                scores[i] = scores.get(i, 0.0) + idf * count * (self.k1 + 1) / (count + norm)
+        return sorted(scores, key=scores.get, reverse=True)[:top_k]
+
+retrieval_indexes = {}
+retrieval_version = None
+
+def get_retrieval_index(lang: str) -> Bm25Index:
+    """Индекс по базе знаний языка и контенту сайта; перестраивается при их изменении"""
+    global retrieval_version
+    version = knowledge_version()
+    if version != retrieval_version:
+        site_chunks = split_site_content(website_cache["content"])
+        retrieval_indexes.clear()
+        for code, knowledge_base in (("ru", COLLEGE_KNOWLEDGE_BASE_RU), ("kz", COLLEGE_KNOWLEDGE_BASE_KZ)):
+            retrieval_indexes[code] = Bm25Index(split_knowledge_base(knowledge_base) + site_chunks)
+        retrieval_version = version
+    return retrieval_indexes[lang]
+
+def retrieve_chunks(question: str, lang: str, top_k: int = None) -> list[str]:
+    index = get_retrieval_index(lang)
+    found = index.search(question, top_k or RETRIEVAL_TOP_K)
+    if not found:
+        # Ничего не нашлось — оставляем контакты, чтобы ИИ мог направить к живым людям
+        found = [0]
+    return [index.chunks[i] for i in sorted(found)]
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов (≈3 символа кириллицы на токен)"""
+    return len(text) // 3
+
+def log_prompt_size_report(questions: list[str]):
+    """Пишет в лог средний размер системного промпта до и после поиска фрагментов"""
+    if not questions:
+        return
+    for lang in ("ru", "kz"):
+        full = estimate_tokens(get_system_prompt(lang))
+        retrieved = sum(estimate_tokens(get_system_prompt(lang, q)) for q in questions) / len(questions)
+        logger.info(f"📏 Промпт ({lang}): вся база ≈{full} ток., с поиском ≈{retrieved:.0f} ток. в среднем")
+
+# --- Очередь исходящих сообщений ---
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BULK = 1
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def reserve(self) -> float:
+        """Забирает токен (в долг, если их нет) и возвращает, сколько секунд нужно подождать"""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def delay(self) -> float:
+        """Сколько ждать до свободного токена, ничего не забирая"""
+        tokens = min(self.burst, self.tokens + (time.monotonic() - self.updated) * self.rate)
+        return 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+
+class OutboundQueue:
+    """Все запросы к Telegram на отправку идут через эту очередь: общий и по-чатовый
+    лимиты, ожидание retry_after при 429, ответы пользователям раньше рассылок."""
+
+    def __init__(self, global_rate: float, chat_rate: float, chat_burst: int, workers: int):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.queue = asyncio.PriorityQueue()
+        self.workers_count = workers
+        self.workers = []
+        self.sequence = 0
+        self.paused_until = 0.0
+        self.deferred = {}  # seq -> (таймер возврата в очередь, элемент)
+        self.last_typing = {}
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+
+    def start(self):
+        if not self.workers:
+            self.workers = [asyncio.create_task(self.worker()) for _ in range(self.workers_count)]
+
+    async def stop(self, timeout: float = SHUTDOWN_TIMEOUT):
+        if not self.workers:
+            return
+        try:
+            # Отложенные сообщения остаются незавершёнными задачами очереди, join() их дождётся
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не отправлено сообщений: {self.queue.qsize() + len(self.deferred)}")
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+        for handle, item in self.deferred.values():
+            handle.cancel()
+            item[-1].cancel()
+        self.deferred = {}
+        while not self.queue.empty():
+            self.queue.get_nowait()[-1].cancel()
+            self.queue.task_done()
+
+    def submit(self, chat_id: int, factory, priority: int = PRIORITY_INTERACTIVE) -> asyncio.Future:
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.sequence += 1
+        self.queue.put_nowait((priority, self.sequence, chat_id, factory, future))
+        return future
+
+    async def send(self, chat_id: int, factory, priority: int = PRIORITY_INTERACTIVE):
+        """factory() — корутина запроса к Telegram; возвращает её результат или бросает её ошибку"""
+        return await self.submit(chat_id, factory, priority)
+
+    def chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= 10000:
+                # Полные корзины ничем не отличаются от новых
+                self.chat_buckets = {c: b for c, b in self.chat_buckets.items() if b.delay() > 0}
+            bucket = self.chat_buckets[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    def requeue_later(self, delay: float, item: tuple):
+        """Возвращает элемент в очередь через delay секунд. task_done() вызывается только
+        после возврата, чтобы queue.join() в stop() не завершился раньше отправки."""
+        seq = item[1]
+
+        def requeue():
+            del self.deferred[seq]
+            self.queue.put_nowait(item)
+            self.queue.task_done()
+
+        self.deferred[seq] = (asyncio.get_running_loop().call_later(delay, requeue), item)
+
+    async def worker(self):
+        while True:
+            item = await self.queue.get()
+            priority, _, chat_id, factory, future = item
+            try:
+                if future.done():
+                    self.queue.task_done()
+                    continue
+                # Во время паузы после 429 возвращаем сообщение в очередь: после неё
+                # очередь снова отдаст первыми ответы пользователям
+                pause = self.paused_until - time.monotonic()
+                if pause > 0:
+                    self.requeue_later(pause, item)
+                    continue
+                # Чат упёрся в свой лимит — откладываем его сообщение, не задерживая другие чаты
+                chat_wait = self.chat_bucket(chat_id).delay()
+                if chat_wait > 0:
+                    self.requeue_later(chat_wait, item)
+                    continue
+                self.chat_bucket(chat_id).reserve()
+                global_wait = self.global_bucket.reserve()
+                if global_wait > 0:
+                    await asyncio.sleep(global_wait)
+                try:
+                    result = await factory()
+                except TelegramRetryAfter as e:
+                    self.retried += 1
+                    self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                    logger.warning(f"Telegram просит подождать {e.retry_after} с (чат {chat_id})")
+                    self.requeue_later(e.retry_after, item)
+                    continue
+                except Exception as e:
+                    self.failed += 1
+                    # Ожидавший ответа обработчик мог быть отменён, пока шёл запрос
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    self.sent += 1
+                    if not future.done():
+                        future.set_result(result)
+            except asyncio.CancelledError:
+                if not future.done():
+                    future.cancel()
+                raise
+            self.queue.task_done()
+
+    def typing(self, chat_id: int):
+        """«Печатает…» не чаще раза в TYPING_INTERVAL секунд на чат; ответа не ждём"""
+        now = time.monotonic()
+        if now - self.last_typing.get(chat_id, 0.0) < TYPING_INTERVAL:
+            return
+        self.last_typing[chat_id] = now
+        future = self.submit(chat_id, lambda: bot.send_chat_action(chat_id, "typing"))
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+    async def keep_typing(self, chat_id: int):
+        """Фоновая задача: поддерживает «Печатает…», пока её не отменят"""
+        while True:
+            self.typing(chat_id)
+            await asyncio.sleep(TYPING_INTERVAL)
+
+    def stats(self) -> dict:
+        return {"queued": self.queue.qsize() + len(self.deferred), "sent": self.sent, "retried": self.retried, "failed": self.failed}
+
+outbound = OutboundQueue(SEND_GLOBAL_RATE, SEND_CHAT_RATE, SEND_CHAT_BURST, SEND_WORKERS)
+
+async def answer(message: Message, text: str, **kwargs) -> Message:
+    """Ответ в чат через очередь исходящих сообщений"""
+    return await outbound.send(message.chat.id, lambda: message.answer(text, **kwargs))
+
+async def broadcast(texts: dict, progress_every: int = 500) -> dict:
+    """Рассылает всем известным пользователям текст на выбранном ими языке"""
+    started = time.perf_counter()
+    recipients = user_lang.items()
+    futures = [
+        outbound.submit(
+            user_id,
+            lambda user_id=user_id, lang=lang: bot.send_message(user_id, texts.get(lang) or texts["ru"]),
+            PRIORITY_BULK,
+        )
+        for user_id, lang in recipients
+    ]
+    report = {"total": len(futures), "sent": 0, "blocked": 0, "failed": 0}
+    for done, future in enumerate(asyncio.as_completed(futures), 1):
+        try:
+            await future
+            report["sent"] += 1
+        except TelegramForbiddenError:
+            report["blocked"] += 1
+        except Exception as e:
+            report["failed"] += 1
+            logger.error(f"Ошибка рассылки: {e}")
+        if done % progress_every == 0:
+            logger.info(f"📣 Рассылка: {done}/{len(futures)}")
+    elapsed = time.perf_counter() - started
+    report["seconds"] = round(elapsed, 1)
+    report["per_second"] = round(report["total"] / elapsed, 1) if elapsed else 0.0
+    logger.info(f"📣 Рассылка завершена: {report}")
+    return report
+
+# --- HTTP-клиент OpenRouter (один на процесс) ---
+llm_client: httpx.AsyncClient | None = None
+llm_semaphore: asyncio.Semaphore | None = None
+
+def create_llm_client() -> httpx.AsyncClient:
+    """Создаёт долгоживущий пул соединений к OpenRouter (keep-alive, HTTP/2)"""
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(LLM_TIMEOUT, connect=10),
+        limits=httpx.Limits(
+            max_connections=LLM_MAX_CONCURRENCY,
+            max_keepalive_connections=LLM_MAX_CONCURRENCY,
+            keepalive_expiry=60,
+        ),
+        headers={
             "Authorization": f"Bearer {OPENROUTER_KEY}",
             "Content-Type": "application/json",
             "X-Title": "KKTiS College Bot"
+        },
+    )
+
+async def start_llm_client():
+    global llm_client, llm_semaphore
+    llm_client = create_llm_client()
+    llm_semaphore = asyncio.Semaphore(LLM_MAX_CONCURRENCY)
+
+async def close_llm_client():
+    global llm_client
+    if llm_client is not None:
+        await llm_client.aclose()
+        llm_client = None
+
+# --- Генерация ответа через OpenRouter ---
+def build_llm_request(prompt: str, lang: str, stream: bool = False, model: str = None) -> dict:
+    system_prompt = get_system_prompt(lang, prompt)
+    data = {
+        "model": model or LLM_MODELS[0],
+        "messages": [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": prompt},
+        ],
+        "temperature": 0.7,
+        "max_tokens": 500
+    }
+    if stream:
+        data["stream"] = True
+        # Последний фрагмент потока содержит расход токенов
+        data["usage"] = {"include": True}
+    return data
+
+def api_error_text(lang: str) -> str:
+    return "⚠️ Сервер уақытша қол жетімсіз." if lang == "kz" else "⚠️ Ошибка при обращении к API."
+
+def generic_error_text(lang: str) -> str:
+    return "Қате орын алды." if lang == "kz" else "Произошла ошибка."
+
+# --- Выбор модели: статистика, circuit breaker, хеджирование ---
+class ModelStats:
+    """Скользящая статистика задержек и ошибок одной модели"""
+
+    def __init__(self, name: str, window: int = 50):
+        self.name = name
+        self.latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)  # True — успех
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+
+    def percentile(self, q: float) -> float | None:
+        if len(self.latencies) < 5:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def available(self, now: float) -> bool:
+        # После паузы модель снова получает запросы (half-open): одна ошибка — и она опять отключена
+        return now >= self.open_until
+
+    def record_success(self, latency: float = None):
+        if latency is not None:
+            self.latencies.append(latency)
+        self.outcomes.append(True)
+        self.consecutive_failures = 0
+
+    def record_failure(self):
+        self.outcomes.append(False)
+        self.consecutive_failures += 1
+        if self.consecutive_failures >= CIRCUIT_FAILURES:
+            self.open_until = time.monotonic() + CIRCUIT_COOLDOWN
+            logger.warning(f"Модель {self.name} отключена на {CIRCUIT_COOLDOWN:.0f} с после ошибок подряд")
+
+    def stats(self) -> dict:
+        return {
+            "p50": self.percentile(0.5),
+            "p95": self.percentile(0.95),
+            "error_rate": self.outcomes.count(False) / len(self.outcomes) if self.outcomes else 0.0,
+            "open": not self.available(time.monotonic()),
         }
-        
-        system_prompt = get_system_prompt(lang)
-        
-        data = {
-            "model": "meta-llama/llama-3-8b-instruct",
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": prompt},
-            ],
-            "temperature": 0.7,
-            "max_tokens": 500
+
+class ModelRouter:
+    """Отправляет запрос основной модели; если она не уложилась в свой p95 — дублирует
+    запрос следующей (хеджирование). Побеждает первый удачный ответ, остальные отменяются."""
+
+    def __init__(self, models: list[str]):
+        self.models = {name: ModelStats(name) for name in models}
+        self.hedged = 0
+        self.fallbacks = 0
+
+    def candidates(self) -> list[ModelStats]:
+        now = time.monotonic()
+        available = [m for m in self.models.values() if m.available(now)]
+        # Если отключены все — пробуем всё равно, по порядку
+        return available or list(self.models.values())
+
+    def hedge_delay(self, model: ModelStats) -> float:
+        p95 = model.percentile(0.95)
+        return max(LLM_HEDGE_MIN_DELAY, p95 if p95 is not None else LLM_HEDGE_DELAY)
+
+    async def attempt(self, model: ModelStats, call, sent: asyncio.Event) -> str:
+        # Ожидание свободного слота — локальная очередь, а не задержка модели: часы
+        # запускаются после него, а sent сообщает complete(), что запрос ушёл к модели
+        async with llm_semaphore:
+            sent.set()
+            started = time.perf_counter()
+            try:
+                result = await call(model.name)
+            except asyncio.CancelledError:
+                LLM_SECONDS.observe(time.perf_counter() - started, model.name, "cancelled")
+                raise
+            except Exception:
+                LLM_SECONDS.observe(time.perf_counter() - started, model.name, "error")
+                model.record_failure()
+                raise
+        latency = time.perf_counter() - started
+        LLM_SECONDS.observe(latency, model.name, "ok")
+        model.record_success(latency)
+        return result
+
+    async def complete(self, call) -> str:
+        """call(model) -> str; бросает последнюю ошибку, если не ответила ни одна модель"""
+        candidates = self.candidates()
+        pending = set()
+        launched = []
+        sent = []
+        last_error = None
+
+        def launch():
+            model = candidates[len(launched)]
+            launched.append(model)
+            sent.append(asyncio.Event())
+            pending.add(asyncio.ensure_future(self.attempt(model, call, sent[-1])))
+
+        launch()
+        try:
+            while pending:
+                can_hedge = len(launched) < len(candidates)
+                if can_hedge and not sent[-1].is_set():
+                    # Таймер хеджирования запускается, только когда запрос ушёл к модели
+                    waiter = asyncio.ensure_future(sent[-1].wait())
+                    done, _ = await asyncio.wait(pending | {waiter}, return_when=asyncio.FIRST_COMPLETED)
+                    waiter.cancel()
+                    done.discard(waiter)
+                else:
+                    timeout = self.hedge_delay(launched[-1]) if can_hedge else None
+                    done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                    # Все слоты заняты — дубль встал бы в ту же локальную очередь, ждём дальше
+                    if not done and not llm_semaphore.locked():
+                        self.hedged += 1
+                        launch()
+                if not done:
+                    continue
+                for task in done:
+                    pending.discard(task)
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+                if not pending and len(launched) < len(candidates):
+                    self.fallbacks += 1
+                    launch()
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "hedged": self.hedged,
+            "fallbacks": self.fallbacks,
+            "models": {name: model.stats() for name, model in self.models.items()},
         }
-        
-        response = requests.post(
-            "https://openrouter.ai/api/v1/chat/completions", 
-            headers=headers, 
-            json=data, 
-            timeout=60
-        )
+
+model_router = ModelRouter(LLM_MODELS)
+
+async def request_completion(prompt: str, lang: str) -> str:
+    """Запрос к OpenRouter через ModelRouter; при ошибке всех моделей бросает исключение"""
+    async def call(model: str) -> str:
+        # Слот llm_semaphore уже занят в ModelRouter.attempt
+        data = build_llm_request(prompt, lang, model=model)
+        response = await llm_client.post(OPENROUTER_URL, json=data)
         
         if response.status_code != 200:
-            logger.error(f"OpenRouter API error: {response.status_code}")
-            return "⚠️ Сервер уақытша қол жетімсіз." if lang == "kz" else "⚠️ Ошибка при обращении к API."
+            logger.error(f"OpenRouter API error ({model}): {response.status_code}")
+            response.raise_for_status()
         
-        return response.json()["choices"][0]["message"]["content"].strip()
+        result = response.json()
+        record_token_usage(model, result.get("usage"))
+        return result["choices"][0]["message"]["content"].strip()
+    
+    return await model_router.complete(call)
+
+def record_token_usage(model: str, usage: dict | None):
+    if usage:
+        LLM_TOKENS.inc(usage.get("prompt_tokens", 0), model, "prompt")
+        LLM_TOKENS.inc(usage.get("completion_tokens", 0), model, "completion")
+
+async def generate_reply(prompt: str, lang: str) -> str:
+    """Запрос к ИИ; кэш проверяет обработчик до планировщика, удачный ответ кладётся в кэш"""
+    try:
+        reply = await request_completion(prompt, lang)
+    except httpx.HTTPStatusError:
+        return api_error_text(lang)
     except Exception as e:
         logger.error(f"Error in generate_reply: {e}")
-        return "Қате орын алды." if lang == "kz" else "Произошла ошибка."
+        return generic_error_text(lang)
+    answer_cache.put(lang, prompt, reply)
+    return reply
+
+async def stream_reply(prompt: str, lang: str):
+    """Потоковая генерация (SSE): отдаёт фрагменты ответа по мере их получения.
+
+    Берётся первая доступная модель; хеджирование для потока не применяется.
+    """
+    model = model_router.candidates()[0]
+    data = build_llm_request(prompt, lang, stream=True, model=model.name)
+    first_token = True
+    started = None
+    try:
+        async with llm_semaphore:
+            # Как и в ModelRouter.attempt, ожидание слота во время ответа модели не входит
+            started = time.perf_counter()
+            async with llm_client.stream("POST", OPENROUTER_URL, json=data) as response:
+                if response.status_code != 200:
+                    logger.error(f"OpenRouter API error ({model.name}): {response.status_code}")
+                    raise httpx.HTTPStatusError(
+                        f"OpenRouter API error: {response.status_code}",
+                        request=response.request, response=response,
+                    )
+                async for line in response.aiter_lines():
+                    # Пустые строки и комментарии SSE (": OPENROUTER PROCESSING") пропускаем
+                    if not line.startswith("data:"):
+                        continue
+                    payload = line[5:].strip()
+                    if payload == "[DONE]":
+                        break
+                    try:
+                        chunk = json.loads(payload)
+                        record_token_usage(model.name, chunk.get("usage"))
+                        delta = chunk["choices"][0].get("delta", {}).get("content")
+                    except (ValueError, KeyError, IndexError):
+                        continue
+                    if delta:
+                        if first_token:
+                            LLM_TTFT_SECONDS.observe(time.perf_counter() - started, model.name)
+                            first_token = False
+                        yield delta
+    except (httpx.HTTPError, OSError):
+        if started is not None:
+            LLM_SECONDS.observe(time.perf_counter() - started, model.name, "error")
+        model.record_failure()
+        raise
+    LLM_SECONDS.observe(time.perf_counter() - started, model.name, "ok")
+    model.record_success()
+
+async def safe_edit(message: Message, text: str, parse_mode=None):
+    """Правит сообщение, игнорируя «message is not modified» и ошибки разметки"""
+    try:
+        await outbound.send(message.chat.id, lambda: message.edit_text(text, parse_mode=parse_mode))
+    except TelegramBadRequest as e:
+        if "not modified" in str(e):
+            return
+        if parse_mode is not None:
+            # Модель вернула некорректный HTML — показываем как обычный текст
+            await safe_edit(message, text, parse_mode=None)
+        else:
+            logger.error(f"Ошибка при редактировании сообщения: {e}")
+
+async def stream_into_message(message: Message, prompt: str, lang: str) -> str:
+    """Отправляет ответ ИИ, обновляя одно сообщение по мере поступления текста.
+
+    Промежуточные правки идут без разметки (HTML может быть незакрыт) и не чаще
+    одного раза в STREAM_EDIT_INTERVAL секунд, финальная — в ParseMode.HTML.
+    Промежуточные правки не ждём: пока генератор стоит на yield, он держит слот
+    llm_semaphore и открытый поток, а очередь исходящих может ждать лимит или 429.
+    Если прошлая правка ещё не ушла, новую пропускаем — следующая покажет больше текста.
+    """
+    reply_message = await answer(message, "⏳", parse_mode=None)
+    text = ""
+    last_edit = time.monotonic()
+    edit = None
+    try:
+        async for delta in stream_reply(prompt, lang):
+            text += delta
+            now = time.monotonic()
+            if now - last_edit >= STREAM_EDIT_INTERVAL and text.strip() and (edit is None or edit.done()):
+                edit = asyncio.create_task(safe_edit(reply_message, text + " ▌"))
+                last_edit = now
+        if text.strip():
+            answer_cache.put(lang, prompt, text.strip())
+    except httpx.HTTPStatusError:
+        text = api_error_text(lang)
+    except Exception as e:
+        logger.error(f"Error in stream_reply: {e}")
+        text = text or generic_error_text(lang)
+    text = text.strip() or generic_error_text(lang)
+    if edit is not None:
+        # Иначе запоздавшая промежуточная правка могла бы затереть финальный текст
+        try:
+            await edit
+        except Exception as e:
+            logger.error(f"Ошибка при редактировании сообщения: {e}")
+    await safe_edit(reply_message, text, parse_mode=ParseMode.HTML)
+    return text
+
+async def answer_streaming(message: Message, prompt: str, lang: str):
+    """Потоковый ответ; совпавшие по времени одинаковые вопросы получают готовый текст целиком"""
+    streamed = False
+
+    async def lead() -> str:
+        nonlocal streamed
+        streamed = True
+        return await stream_into_message(message, prompt, lang)
+
+    text = await llm_scheduler.run(lang, prompt, lead)
+    if not streamed:
+        await answer(message, text)
+
+# --- Планировщик запросов к ИИ ---
+def rate_limited_text(lang: str) -> str:
+    return (
+        "⏳ Сұрақтар тым жиі қойылды. Біраз күтіп, қайта сұраңыз."
+        if lang == "kz"
+        else "⏳ Слишком много вопросов подряд. Подождите немного и спросите снова."
+    )
+
+def busy_text(lang: str) -> str:
+    return (
+        "⚠️ Қазір сұрақтар өте көп, сәл кейінірек қайталап көріңіз."
+        if lang == "kz"
+        else "⚠️ Сейчас очень много вопросов, попробуйте чуть позже."
+    )
+
+class LlmScheduler:
+    """Объединяет одинаковые одновременные запросы, ограничивает частоту по пользователю
+    (token bucket) и отбрасывает лишнюю нагрузку при переполнении очереди."""
+
+    def __init__(self, rate_per_minute: float, burst: int, max_pending: int):
+        self.rate = rate_per_minute / 60
+        self.burst = burst
+        self.max_pending = max_pending
+        self.buckets = {}  # user_id -> [токены, время последнего пополнения]
+        self.inflight = {}  # (язык, нормализованный вопрос) -> задача
+        self.pending = 0
+        self.coalesced = 0
+        self.shed = 0
+        self.rate_limited = 0
+
+    def allow(self, user_id: int) -> bool:
+        """Списывает токен пользователя; False — лимит исчерпан"""
+        now = time.monotonic()
+        bucket = self.buckets.get(user_id)
+        if bucket is None:
+            if len(self.buckets) >= 10000:
+                self.prune(now)
+            bucket = self.buckets[user_id] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            self.rate_limited += 1
+            return False
+        bucket[0] -= 1
+        return True
+
+    def prune(self, now: float):
+        """Удаляет полностью восстановившиеся корзины — они ничем не отличаются от новых"""
+        full_after = self.burst / self.rate if self.rate else float("inf")
+        for user_id in [u for u, (_, ts) in self.buckets.items() if now - ts >= full_after]:
+            del self.buckets[user_id]
+
+    async def run(self, lang: str, prompt: str, factory) -> str:
+        """Выполняет factory() один раз на группу одинаковых вопросов; при перегрузке — отказ"""
+        key = (lang, normalize_question(prompt))
+        task = self.inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            if self.pending >= self.max_pending:
+                self.shed += 1
+                logger.warning(f"Очередь к ИИ переполнена ({self.pending}), запрос отклонён")
+                return busy_text(lang)
+            self.pending += 1
+            task = self.inflight[key] = asyncio.ensure_future(factory())
+            task.add_done_callback(lambda _: self.finish(key))
+        # shield: отмена одного ожидающего не отменяет общий запрос
+        return await asyncio.shield(task)
+
+    def finish(self, key):
+        self.inflight.pop(key, None)
+        self.pending -= 1
+
+    def stats(self) -> dict:
+        return {
+            "pending": self.pending,
+            "queued": max(0, self.pending - LLM_MAX_CONCURRENCY),
+            "coalesced": self.coalesced,
+            "shed": self.shed,
+            "rate_limited": self.rate_limited,
+        }
+
+llm_scheduler = LlmScheduler(USER_RATE_PER_MINUTE, USER_RATE_BURST, LLM_MAX_CONCURRENCY + LLM_QUEUE_SIZE)
 
 # --- /start ---
 @dp.message(CommandStart())
@@ -243,7 +1912,7 @@ async def cmd_start(message: Message):
         ],
         resize_keyboard=True
     )
-    await message.answer(text, reply_markup=keyboard)
+    await answer(message, text, reply_markup=keyboard)
 
 # --- Выбор языка ---
 @dp.message(F.text.in_(["🇷🇺 Русский", "🇰🇿 Қазақ тілі"]))
@@ -254,12 +1923,12 @@ async def select_language(message: Message):
     else:
         user_lang[message.from_user.id] = "ru"
         text = f"🇷🇺 Язык изменён на русский.\n\n🎓 <b>{COLLEGE_NAME_RU}</b>\nВыберите раздел или задайте вопрос 👇"
-    await message.answer(text, reply_markup=get_main_keyboard(user_lang[message.from_user.id]))
+    await answer(message, text, reply_markup=get_main_keyboard(user_lang[message.from_user.id]))
 
 # --- Смена языка ---
 @dp.message(F.text.in_(["🌐 Сменить язык", "🌐 Тілді ауыстыру"]))
 async def change_language(message: Message):
-    current_lang = user_lang.get(message.from_user.id, "ru")
+    current_lang = await user_lang.get(message.from_user.id, "ru")
     new_lang = "kz" if current_lang == "ru" else "ru"
     user_lang[message.from_user.id] = new_lang
     text = (
@@ -267,108 +1936,225 @@ async def change_language(message: Message):
         if new_lang == "kz"
         else f"🇷🇺 Язык изменён на русский.\n\n🎓 <b>{COLLEGE_NAME_RU}</b>\nВыберите нужный раздел 👇"
     )
-    await message.answer(text, reply_markup=get_main_keyboard(new_lang))
+    await answer(message, text, reply_markup=get_main_keyboard(new_lang))
 
 # --- Назад ---
 @dp.message(F.text.in_(["🔙 Назад", "🔙 Артқа"]))
 async def go_back(message: Message):
-    lang = user_lang.get(message.from_user.id, "ru")
+    lang = await user_lang.get(message.from_user.id, "ru")
     if lang == "kz":
         text = f"🎓 <b>{COLLEGE_NAME_KZ}</b>\nТөменнен қажетті бөлімді таңдаңыз 👇"
     else:
         text = f"🎓 <b>{COLLEGE_NAME_RU}</b>\nВыберите нужный раздел 👇"
-    await message.answer(text, reply_markup=get_main_keyboard(lang))
+    await answer(message, text, reply_markup=get_main_keyboard(lang))
 
 # --- Расписание ---
 @dp.message(F.text.in_(["📅 Расписание", "📅 Сабақ кестесі"]))
 async def show_schedule(message: Message):
-    lang = user_lang.get(message.from_user.id, "ru")
-    text = (
-        f"📅 <b>Сабақ кестесі</b>\n\n🔗 <a href='{SCHEDULE_URL}'>Кестені ашу</a>\n\n🌐 {SITE_URL}"
-        if lang == "kz"
-        else f"📅 <b>Расписание занятий</b>\n\n🔗 <a href='{SCHEDULE_URL}'>Открыть расписание</a>\n\n🌐 {SITE_URL}"
-    )
-    await message.answer(text, parse_mode=ParseMode.HTML, reply_markup=get_back_keyboard(lang))
+    lang = await user_lang.get(message.from_user.id, "ru")
+    text = get_schedule_text(lang)
+    await answer(message, text, parse_mode=ParseMode.HTML, reply_markup=get_back_keyboard(lang))
 
 # --- Контакты ---
 @dp.message(F.text.in_(["📞 Контакты", "📞 Байланыс"]))
 async def show_contacts(message: Message):
-    lang = user_lang.get(message.from_user.id, "ru")
-    text = (
-        "📞 <b>Байланыс:</b>\n📍 Қарағанды, Затаевич к., 75\n☎️ 8-7212-37-58-44\n✉️ krg-koll-7092@bilim09.kz\n🌐 https://kktis.kz/"
-        if lang == "kz"
-        else "📞 <b>Контакты:</b>\n📍 Караганда, ул. Затаевича, 75\n☎️ 8-7212-37-58-44\n✉️ krg-koll-7092@bilim09.kz\n🌐 https://kktis.kz/"
-    )
-    await message.answer(text, parse_mode=ParseMode.HTML, reply_markup=get_back_keyboard(lang))
+    lang = await user_lang.get(message.from_user.id, "ru")
+    text = get_contacts_text(lang)
+    await answer(message, text, parse_mode=ParseMode.HTML, reply_markup=get_back_keyboard(lang))
 
 # --- Приёмная комиссия ---
 @dp.message(F.text.in_(["🎓 Приёмная комиссия", "🎓 Қабылдау комиссиясы"]))
 async def show_admission(message: Message):
-    lang = user_lang.get(message.from_user.id, "ru")
-    text = (
-        "🎓 <b>ҚАБЫЛДАУ КОМИССИЯСЫ</b>\n\nҚарағанды технология және сервис колледжі келесі мамандықтар бойынша оқуға шақырады:\n\n"
-        "💻 Цифрлық техника — 11 сынып негізінде, 10 ай\n✂️ Шаштараз өнері — 9 сынып негізінде, 2 жыл 10 ай\n"
-        "👗 Киім өндірісі және үлгілеу — 9 сынып негізінде, 2 жыл 10 ай\n🧵 Тігінші — 9 сынып негізінде, 2 жыл 10 ай\n"
-        "👞 Аяқ киім ісі — ТиПО негізінде, 10 ай\n💼 Офис-менеджер — 11 сынып негізінде, 10 ай\n\n"
-        "📋 Қажетті құжаттар:\n1️⃣ Өтініш\n2️⃣ Білім туралы құжат\n3️⃣ 3x4 фото (4 дана)\n4️⃣ 075У мед. анықтама\n\n"
-        "📍 Мекенжайы: Қарағанды қ., Затаевич к., 75\n"
-        "📞 Әмірханова М.А. — 8-701-842-25-36\n📞 Искакова Г.К. — 8-700-145-45-36\n⏰ Дс–Жм: 08:00–17:00"
-        if lang == "kz"
-        else
-        "🎓 <b>ПРИЁМНАЯ КОМИССИЯ</b>\n\nКарагандинский колледж технологии и сервиса приглашает абитуриентов:\n\n"
-        "💻 Цифровая техника — 11 кл., 10 мес.\n✂️ Парикмахерское искусство — 9 кл., 2 г. 10 мес.\n"
-        "👗 Швейное производство и моделирование одежды — 9 кл., 2 г. 10 мес.\n🧵 Портной — 9 кл., 2 г. 10 мес.\n"
-        "👞 Обувное дело — 10 мес.\n💼 Офис-менеджер — 11 кл., 10 мес.\n\n"
-        "📋 Документы:\n1️⃣ Заявление\n2️⃣ Документ об образовании\n3️⃣ Фото 3×4 (4 шт.)\n4️⃣ Медсправка 075У\n\n"
-        "📍 Адрес: Караганда, ул. Затаевича, 75\n📞 Әмірханова М.А. — 8-701-842-25-36\n📞 Искакова Г.К. — 8-700-145-45-36\n⏰ Пн–Пт: 08:00–17:00"
-    )
-    await message.answer(text, parse_mode=ParseMode.HTML, reply_markup=get_back_keyboard(lang))
+    lang = await user_lang.get(message.from_user.id, "ru")
+    text = get_admission_text(lang)
+    await answer(message, text, parse_mode=ParseMode.HTML, reply_markup=get_back_keyboard(lang))
 
 # --- Расписание звонков ---
 @dp.message(F.text.in_(["⏰ Расписание звонков", "⏰ Қоңырау кестесі"]))
 async def show_bell_schedule(message: Message):
-    lang = user_lang.get(message.from_user.id, "ru")
-    if lang == "kz":
-        text = (
-            "<b>⏰ Қоңырау кестесі</b>\n\n<b>Дүйсенбі:</b>\nКураторлық сағат — 09:00 – 09:45\n"
-            "Үзіліс — 5 мин\n1-пара — 09:50 – 11:20\n\nТүскі ас (1-ағын) — 20 мин\n2-пара — 11:40 – 13:10\n\n"
-            "Түскі ас (2-ағын) — 20 мин\n3-пара — 13:30 – 15:00\n\n——————————————\n<b>Сейсенбі – Жұма:</b>\n"
-            "1-пара — 09:00 – 10:30\nҮзіліс — 10 мин\n2-пара — 10:40 – 12:10\n\nТүскі ас (1-ағын) — 20 мин\n"
-            "3-пара — 12:30 – 14:00\n\nТүскі ас (2-ағын) — 20 мин\n4-пара — 14:20 – 15:50"
-        )
-    else:
+    lang = await user_lang.get(message.from_user.id, "ru")
+    text = get_bell_schedule_text(lang)
+    await answer(message, text, parse_mode=ParseMode.HTML, reply_markup=get_back_keyboard(lang))
+
+# --- Расписание группы: /schedule ЦТ-21 ср ---
+@dp.message(Command("schedule"))
+async def group_schedule(message: Message, command: CommandObject):
+    lang = await user_lang.get(message.from_user.id, "ru")
+    text = get_group_schedule_answer(command.args or "", lang)
+    if text is None:
         text = (
-            "<b>⏰ Расписание звонков</b>\n\n<b>Понедельник:</b>\nКураторский час — 09:00 – 09:45\n"
-            "Перемена — 5 мин\n1 пара — 09:50 – 11:20\n\nОбед (1-й поток) — 20 мин\n2 пара — 11:40 – 13:10\n\n"
-            "Обед (2-й поток) — 20 мин\n3 пара — 13:30 – 15:00\n\n——————————————\n<b>Вторник – Пятница:</b>\n"
-            "1 пара — 09:00 – 10:30\nПеремена — 10 мин\n2 пара — 10:40 – 12:10\n\nОбед (1-й поток) — 20 мин\n"
-            "3 пара — 12:30 – 14:00\n\nОбед (2-й поток) — 20 мин\n4 пара — 14:20 – 15:50"
+            "Топты көрсетіңіз, мысалы: <code>/schedule ЦТ-21 сәрсенбі</code>"
+            if lang == "kz"
+            else "Укажите группу, например: <code>/schedule ЦТ-21 среда</code>"
         )
-    await message.answer(text, parse_mode=ParseMode.HTML, reply_markup=get_back_keyboard(lang))
+    await answer(message, text, parse_mode=ParseMode.HTML)
+
+# --- Рассылка (только для администраторов) ---
+@dp.message(Command("broadcast"), F.from_user.id.in_(ADMIN_IDS))
+async def cmd_broadcast(message: Message, command: CommandObject):
+    """/broadcast <текст RU>, затем строка «---» и <текст KZ> (без неё — один текст для всех)"""
+    if not command.args:
+        await answer(message, "Использование: /broadcast текст RU\n---\nтекст KZ", parse_mode=None)
+        return
+    parts = [part.strip() for part in command.args.split("\n---\n", 1)]
+    texts = {"ru": parts[0], "kz": parts[-1]}
+    await answer(message, f"📣 Рассылка начата: {len(user_lang.items())} получателей", parse_mode=None)
+    report = await broadcast(texts)
+    await answer(
+        message,
+        f"📣 Рассылка завершена за {report['seconds']} с ({report['per_second']}/с)\n"
+        f"Доставлено: {report['sent']}, заблокировали бота: {report['blocked']}, ошибок: {report['failed']}",
+        parse_mode=None,
+    )
 
 # --- Чат с ИИ ---
 @dp.message()
 async def chat(message: Message):
-    lang = user_lang.get(message.from_user.id, "ru")
+    lang = await user_lang.get(message.from_user.id, "ru")
     prompt = message.text
     
-    # Отправляем индикатор набора текста
-    await bot.send_chat_action(message.chat.id, "typing")
+    # Вопросы про пары конкретной группы отвечаем по загруженному расписанию
+    schedule_answer = get_group_schedule_answer(prompt, lang, require_cue=True)
+    if schedule_answer is not None:
+        await answer(message, schedule_answer, parse_mode=ParseMode.HTML)
+        return
+    
+    # Частые вопросы отвечаем сразу готовыми текстами
+    faq_answer = get_faq_answer(prompt, lang)
+    if faq_answer is not None:
+        await answer(message, faq_answer, parse_mode=ParseMode.HTML)
+        return
+    
+    cached = answer_cache.get(lang, prompt)
+    if cached is not None:
+        await answer(message, cached)
+        return
+    
+    if not llm_scheduler.allow(message.from_user.id):
+        await answer(message, rate_limited_text(lang))
+        return
     
-    reply = await generate_reply(prompt, lang)
-    await message.answer(reply)
+    # Индикатор набора текста обновляется в фоне, пока ждём ИИ
+    typing = asyncio.create_task(outbound.keep_typing(message.chat.id))
+    try:
+        if STREAM_REPLIES:
+            await answer_streaming(message, prompt, lang)
+            return
+        
+        reply = await llm_scheduler.run(lang, prompt, lambda: generate_reply(prompt, lang))
+    finally:
+        typing.cancel()
+    await answer(message, reply)
+
+# --- Режим вебхука ---
+async def webhook_worker(queue: asyncio.Queue):
+    """Обрабатывает обновления из очереди; время обработки пишется в лог"""
+    while True:
+        received_at, update = await queue.get()
+        try:
+            await dp.feed_update(bot, update)
+        except Exception as e:
+            logger.error(f"Ошибка при обработке обновления {update.update_id}: {e}")
+        finally:
+            queue.task_done()
+            elapsed = time.perf_counter() - received_at
+            UPDATE_SECONDS.observe(elapsed)
+            logger.debug(f"Обновление {update.update_id} обработано за {elapsed * 1000:.0f} мс")
+
+def create_webhook_app(queue: asyncio.Queue) -> web.Application:
+    async def handle_update(request: web.Request) -> web.Response:
+        if request.headers.get("X-Telegram-Bot-Api-Secret-Token") != WEBHOOK_SECRET:
+            return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": bot})
+        except ValueError as e:
+            # Битый JSON или ошибка валидации (pydantic.ValidationError — тоже ValueError).
+            # Отвечаем 200, иначе Telegram будет бесконечно передоставлять это обновление
+            logger.error(f"Некорректное обновление отброшено: {e}")
+            return web.Response()
+        try:
+            queue.put_nowait((time.perf_counter(), update))
+        except asyncio.QueueFull:
+            # Telegram повторит доставку позже
+            logger.warning("Очередь обновлений переполнена")
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(WEBHOOK_PATH, handle_update)
+    return app
+
+async def run_webhook():
+    """Принимает обновления через aiohttp-сервер и обрабатывает их пулом из WEBHOOK_WORKERS задач"""
+    # Без секрета любой, кто достучится до порта, сможет подсовывать поддельные обновления
+    if not WEBHOOK_URL or not WEBHOOK_SECRET:
+        raise RuntimeError("Для BOT_MODE=webhook нужно задать WEBHOOK_URL и WEBHOOK_SECRET")
+    queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+    workers = [asyncio.create_task(webhook_worker(queue)) for _ in range(WEBHOOK_WORKERS)]
+    runner = web.AppRunner(create_webhook_app(queue))
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    await bot.set_webhook(
+        WEBHOOK_URL,
+        secret_token=WEBHOOK_SECRET,
+        allowed_updates=dp.resolve_used_update_types(),
+    )
+    logger.info(f"🔗 Вебхук: {WEBHOOK_URL} (порт {WEBHOOK_PORT}, обработчиков {WEBHOOK_WORKERS})")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        # Перестаём принимать новые обновления и даём завершиться начатым (в т.ч. запросам к ИИ)
+        logger.info("⏳ Завершение: ждём обработки принятых обновлений")
+        await runner.cleanup()
+        try:
+            await asyncio.wait_for(queue.join(), SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Не обработано обновлений: {queue.qsize()}")
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        await outbound.stop()
+        await bot.session.close()
 
 # --- Основной запуск ---
 async def main():
     logger.info("✅ Бот запущен и готов к работе!")
     logger.info(f"📍 Официальный сайт: {SITE_URL}")
     
-    # Опционально: загрузка информации с сайта при старте
-    # website_info = fetch_website_info()
-    # if website_info:
-    #     logger.info("📄 Информация с сайта загружена")
+    log_prompt_size_report([phrase for phrases in FAQ_INTENTS.values() for phrase in phrases])
     
-    await dp.start_polling(bot)
+    user_lang.backend = create_state_backend()
+    user_lang.warm_up()
+    state_flusher = asyncio.create_task(user_lang.run_flusher())
+    await start_llm_client()
+    crawler = asyncio.create_task(crawl_site_forever())
+    schedule_loader = asyncio.create_task(refresh_schedule_forever())
+    metrics_runner = await start_metrics_server()
+    if profiler:
+        profiler.start()
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook()
+        else:
+            await dp.start_polling(bot)
+    finally:
+        crawler.cancel()
+        schedule_loader.cancel()
+        await outbound.stop()
+        state_flusher.cancel()
+        if metrics_runner:
+            await metrics_runner.cleanup()
+        await user_lang.flush()
+        user_lang.backend.close()
+        await close_llm_client()
+        logger.info(f"📊 Кэш ответов: {answer_cache.stats()}")
+        logger.info(f"📊 Планировщик ИИ: {llm_scheduler.stats()}")
+        logger.info(f"📊 Модели: {model_router.stats()}")
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,237 @@
+"""Нагрузочный бенчмарк бота без Telegram и OpenRouter.
+
+Реальный диспетчер `dp` получает синтетические обновления (RU/KZ, кнопки меню и
+свободные вопросы). Ответы ИИ отдаёт локальная заглушка OpenRouter с настраиваемой
+задержкой, потоковым режимом и долей ошибок, а запросы к Telegram записывает
+сессия-заглушка.
+
+Запуск: python bench.py --updates 2000 --concurrency 1,10,50,200 --llm-latency 0.5
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import random
+import time
+
+from aiohttp import web
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import EditMessageText, SendMessage
+from aiogram.types import Message, Update
+
+import V4GPT
+
+MENU_BUTTONS = {
+    "ru": ["📅 Расписание", "🎓 Приёмная комиссия", "📞 Контакты", "⏰ Расписание звонков", "🔙 Назад"],
+    "kz": ["📅 Сабақ кестесі", "🎓 Қабылдау комиссиясы", "📞 Байланыс", "⏰ Қоңырау кестесі", "🔙 Артқа"],
+}
+
+FREE_TEXT = {
+    "ru": [
+        "Какие документы нужны для поступления?", "Есть ли общежитие?", "Сколько стоит обучение?",
+        "Когда начинается учебный год?", "Можно ли поступить после 11 класса на парикмахера?",
+        "Есть ли бюджетные места?", "Где посмотреть расписание?", "Когда звонок?",
+    ],
+    "kz": [
+        "Қандай құжаттар керек?", "Жатақхана бар ма?", "Оқу ақылы ма?",
+        "Оқу жылы қашан басталады?", "Бюджеттік орындар бар ма?", "Қоңырау кестесі қандай?",
+    ],
+}
+
+
+# --- Заглушка OpenRouter ---
+def create_openrouter_stub(latency: float, error_rate: float) -> web.Application:
+    async def completions(request: web.Request) -> web.StreamResponse:
+        data = await request.json()
+        await asyncio.sleep(latency * random.uniform(0.5, 1.5))
+        if random.random() < error_rate:
+            return web.Response(status=502)
+        answer = "Ответ заглушки на вопрос: " + data["messages"][-1]["content"]
+        usage = {"prompt_tokens": len(data["messages"][0]["content"]) // 3, "completion_tokens": 40}
+        if not data.get("stream"):
+            return web.json_response({"choices": [{"message": {"content": answer}}], "usage": usage})
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+        for word in answer.split():
+            chunk = {"choices": [{"delta": {"content": word + " "}}]}
+            await response.write(f"data: {json.dumps(chunk)}\n\n".encode())
+            await asyncio.sleep(0.01)
+        await response.write(f"data: {json.dumps({'choices': [{'delta': {}}], 'usage': usage})}\n\n".encode())
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    app = web.Application()
+    app.router.add_post("/api/v1/chat/completions", completions)
+    return app
+
+
+# --- Заглушка сессии Telegram ---
+class RecordingSession(BaseSession):
+    """Не ходит в сеть: записывает вызванные методы и возвращает правдоподобный ответ"""
+
+    def __init__(self, latency: float = 0.0):
+        super().__init__()
+        self.latency = latency
+        self.calls = {}
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, (SendMessage, EditMessageText)):
+            return Message(
+                message_id=random.randint(1, 10**9),
+                date=datetime.datetime.now(),
+                chat={"id": method.chat_id or 0, "type": "private"},
+                text=method.text,
+            ).as_(bot)
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        """Файлы бот не скачивает: отдаём пустое содержимое"""
+        yield b""
+
+    async def close(self):
+        pass
+
+
+# --- Синтетические обновления ---
+def make_update(update_id: int, free_text_share: float, unique: bool = False) -> Update:
+    user_id = random.randint(1, 5000)
+    lang = "kz" if user_id % 3 == 0 else "ru"
+    V4GPT.user_lang[user_id] = lang
+    if random.random() < free_text_share:
+        text = random.choice(FREE_TEXT[lang])
+        if unique:
+            # Разный текст — нет объединения одинаковых запросов в планировщике
+            text += f" (вопрос {update_id})"
+    else:
+        text = random.choice(MENU_BUTTONS[lang])
+    return Update.model_validate(
+        {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "from": {"id": user_id, "is_bot": False, "first_name": "bench"},
+                "text": text,
+            },
+        },
+        context={"bot": V4GPT.bot},
+    )
+
+
+async def measure_loop_lag(samples: list, stop: asyncio.Event, interval: float = 0.01):
+    """Насколько позже запланированного просыпается event loop"""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        samples.append(max(0.0, loop.time() - expected))
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))] if ordered else 0.0
+
+
+async def run_level(concurrency: int, total: int, free_text_share: float, unique: bool) -> dict:
+    V4GPT.answer_cache.clear()
+    updates = [make_update(i, free_text_share, unique) for i in range(total)]
+    queue = asyncio.Queue()
+    for update in updates:
+        queue.put_nowait(update)
+    latencies = []
+
+    async def worker():
+        while not queue.empty():
+            update = queue.get_nowait()
+            started = time.perf_counter()
+            await V4GPT.dp.feed_update(V4GPT.bot, update)
+            latencies.append(time.perf_counter() - started)
+
+    lag, stop = [], asyncio.Event()
+    lag_task = asyncio.create_task(measure_loop_lag(lag, stop))
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await lag_task
+    return {
+        "concurrency": concurrency,
+        "rate": total / elapsed,
+        "p50": percentile(latencies, 0.5),
+        "p95": percentile(latencies, 0.95),
+        "p99": percentile(latencies, 0.99),
+        "lag_p99": percentile(lag, 0.99),
+        "lag_max": max(lag, default=0.0),
+    }
+
+
+async def main(args):
+    random.seed(args.seed)
+    logging.disable(logging.INFO)
+    stub = web.AppRunner(create_openrouter_stub(args.llm_latency, args.error_rate))
+    await stub.setup()
+    site = web.TCPSite(stub, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+
+    V4GPT.OPENROUTER_URL = f"http://127.0.0.1:{port}/api/v1/chat/completions"
+    V4GPT.STREAM_REPLIES = args.stream
+    # Без лимита на пользователя: меряем пропускную способность, а не защиту от спама
+    V4GPT.llm_scheduler = V4GPT.LlmScheduler(
+        10**9, 10**9, V4GPT.LLM_MAX_CONCURRENCY + V4GPT.LLM_QUEUE_SIZE
+    )
+    # Лимиты Telegram на отправку заглушке не нужны, если их явно не задали
+    V4GPT.outbound = V4GPT.OutboundQueue(args.send_rate, args.send_rate, args.send_rate, V4GPT.SEND_WORKERS)
+    session = RecordingSession(args.telegram_latency)
+    session.middleware(V4GPT.TelegramTimingMiddleware())
+    V4GPT.bot.session = session
+    if args.llm_only:
+        # Свободные вопросы не отвечаются готовым текстом и не берутся из кэша
+        V4GPT.FAQ_MATCH_THRESHOLD = float("inf")
+        V4GPT.answer_cache = V4GPT.AnswerCache(0, V4GPT.ANSWER_CACHE_TTL)
+    await V4GPT.start_llm_client()
+
+    print(
+        f"LLM: {args.llm_latency * 1000:.0f} мс, ошибки {args.error_rate:.0%}, "
+        f"поток: {'да' if args.stream else 'нет'}, свободных вопросов {args.free_text:.0%}"
+        f"{', все в ИИ' if args.llm_only else ''}"
+    )
+    print(f"{'параллельно':>11} {'обн./с':>9} {'p50 мс':>8} {'p95 мс':>8} {'p99 мс':>8} {'лаг p99':>8} {'лаг max':>8}")
+    try:
+        for concurrency in args.concurrency:
+            r = await run_level(concurrency, args.updates, args.free_text, args.llm_only)
+            print(
+                f"{r['concurrency']:>11} {r['rate']:>9.1f} {r['p50'] * 1000:>8.1f} {r['p95'] * 1000:>8.1f} "
+                f"{r['p99'] * 1000:>8.1f} {r['lag_p99'] * 1000:>8.1f} {r['lag_max'] * 1000:>8.1f}"
+            )
+    finally:
+        await V4GPT.outbound.stop()
+        await V4GPT.close_llm_client()
+        await stub.cleanup()
+    print(f"Запросы к Telegram: {session.calls}")
+    print(f"Кэш: {V4GPT.answer_cache.stats()}, планировщик: {V4GPT.llm_scheduler.stats()}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--updates", type=int, default=1000, help="обновлений на каждый уровень")
+    parser.add_argument("--concurrency", type=lambda v: [int(x) for x in v.split(",")], default=[1, 10, 50, 200])
+    parser.add_argument("--free-text", type=float, default=0.5, help="доля свободных вопросов")
+    parser.add_argument("--llm-latency", type=float, default=0.5, help="средняя задержка заглушки OpenRouter, сек.")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="доля ответов 502 от заглушки")
+    parser.add_argument("--stream", action="store_true", help="включить STREAM_REPLIES")
+    parser.add_argument(
+        "--llm-only", action="store_true",
+        help="каждый свободный вопрос идёт в ИИ: без частых вопросов, кэша ответов и объединения одинаковых",
+    )
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="задержка заглушки Telegram, сек.")
+    parser.add_argument("--send-rate", type=float, default=10**6, help="лимит очереди исходящих, сообщений/с")
+    parser.add_argument("--seed", type=int, default=1)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,95 @@
+"""Оценка локального классификатора частых вопросов на размеченном наборе RU/KZ.
+
+Запуск: python faq_eval.py [порог]
+Печатает точность (precision), долю вопросов, ушедших мимо ИИ, и время ответа.
+"""
+import sys
+import time
+
+from V4GPT import FAQ_MATCH_THRESHOLD, faq_matcher
+
+# (вопрос, ожидаемый раздел или None — вопрос должен уйти к ИИ)
+LABELED_QUESTIONS = [
+    ("Какой у вас адрес?", "contacts"),
+    ("где вы находитесь", "contacts"),
+    ("дайте номер телефона колледжа", "contacts"),
+    ("Как связаться с колледжем?", "contacts"),
+    ("почта колледжа какая", "contacts"),
+    ("Колледж мекенжайы қандай?", "contacts"),
+    ("колледж телефоны", "contacts"),
+    ("сіздермен қалай байланысамын", "contacts"),
+    ("какие документы нужны", "admission"),
+    ("Какие документы нужны для поступления?", "admission"),
+    ("какие специальности есть в колледже", "admission"),
+    ("как поступить после 9 класса", "admission"),
+    ("сколько учиться на парикмахера", "admission"),
+    ("когда работает приемная комиссия", "admission"),
+    ("қандай құжаттар қажет", "admission"),
+    ("кандай кужаттар керек", "admission"),
+    ("колледжге калай тусуге болады", "admission"),
+    ("Қандай мамандықтар бар?", "admission"),
+    ("когда звонок", "bell_schedule"),
+    ("Во сколько начинается первая пара?", "bell_schedule"),
+    ("когда обед у второго потока", "bell_schedule"),
+    ("во сколько заканчиваются занятия", "bell_schedule"),
+    ("расписание звонков на понедельник", "bell_schedule"),
+    ("қоңырау кестесі қандай", "bell_schedule"),
+    ("бірінші пара нешеде басталады", "bell_schedule"),
+    ("үзіліс қанша минут", "bell_schedule"),
+    ("где расписание занятий", "schedule"),
+    ("скиньте ссылку на расписание", "schedule"),
+    ("сабақ кестесін қайдан табамын", "schedule"),
+    ("Есть ли общежитие?", None),
+    ("сколько стоит обучение", None),
+    ("есть ли бюджетные места", None),
+    ("кто директор колледжа", None),
+    ("можно ли перевестись из другого колледжа", None),
+    ("какая погода завтра", None),
+    ("напиши стих про кошку", None),
+    ("жатақхана бар ма", None),
+    ("оқу ақылы ма", None),
+    ("спорт секциялары бар ма", None),
+    # Отложенные негативы: делят слово с примерами разделов, но спрашивают о другом
+    ("где находится столовая", None),
+    ("телефон бухгалтерии", None),
+    ("какой телефон у директора", None),
+    ("какие документы нужны для стипендии", None),
+    ("где посмотреть оценки", None),
+    ("расписание экзаменов", None),
+    ("когда начинается учеба", None),
+    ("адрес общежития", None),
+    ("почта директора", None),
+    ("когда сессия", None),
+    ("кестеде емтихан қашан", None),
+    ("асхана қайда орналасқан", None),
+    ("стипендияға қандай құжаттар керек", None),
+    # Неоднозначные: слово из словаря нескольких разделов, выбрать один нельзя
+    ("расписание", None),
+    ("телефон", None),
+    ("телефоны", None),
+]
+
+
+def evaluate(threshold: float) -> dict:
+    answered = correct = 0
+    start = time.perf_counter()
+    for question, expected in LABELED_QUESTIONS:
+        predicted = faq_matcher.match(question, threshold)
+        if predicted is not None:
+            answered += 1
+            correct += predicted == expected
+    elapsed = time.perf_counter() - start
+    return {
+        "threshold": threshold,
+        "precision": correct / answered if answered else 1.0,
+        "offload": answered / len(LABELED_QUESTIONS),
+        "avg_ms": elapsed / len(LABELED_QUESTIONS) * 1000,
+    }
+
+
+if __name__ == "__main__":
+    thresholds = [float(sys.argv[1])] if len(sys.argv) > 1 else sorted({0.6, 0.7, FAQ_MATCH_THRESHOLD, 0.8, 0.9})
+    print(f"{'порог':>6} {'precision':>10} {'мимо ИИ':>8} {'мс/вопрос':>10}")
+    for threshold in thresholds:
+        r = evaluate(threshold)
+        print(f"{r['threshold']:>6.2f} {r['precision']:>10.2%} {r['offload']:>8.2%} {r['avg_ms']:>10.3f}")
@@ -0,0 +1,68 @@
+"""Бенчмарк хранилища языков пользователей: память на 100k пользователей и скорость чтения/записи.
+
+Запуск: python state_bench.py [число пользователей]
+"""
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from V4GPT import MemoryStateBackend, SqliteStateBackend, UserLangStore
+
+
+def measure_memory(users: int) -> float:
+    """Байт на пользователя: словарь-кэш плюс ещё не сброшенная очередь записи"""
+    store = UserLangStore(MemoryStateBackend())
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for user_id in range(users):
+        store[1_000_000_000 + user_id] = "kz" if user_id % 3 == 0 else "ru"
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return (after - before) / users
+
+
+async def measure_backend(name: str, backend, users: int):
+    store = UserLangStore(backend)
+    user_ids = [1_000_000_000 + i for i in range(users)]
+
+    start = time.perf_counter()
+    for user_id in user_ids:
+        store[user_id] = "kz" if user_id % 3 == 0 else "ru"
+    set_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    await store.flush()
+    flush_elapsed = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for user_id in user_ids:
+        await store.get(user_id, "ru")
+    get_elapsed = time.perf_counter() - start
+
+    cold = UserLangStore(backend)
+    start = time.perf_counter()
+    cold.warm_up()
+    warm_elapsed = time.perf_counter() - start
+
+    print(
+        f"{name:>7}: запись {users / set_elapsed:>12,.0f}/с, "
+        f"сброс на диск {users / flush_elapsed:>10,.0f}/с, "
+        f"чтение {users / get_elapsed:>12,.0f}/с, "
+        f"загрузка при старте {warm_elapsed * 1000:.0f} мс"
+    )
+
+
+async def main(users: int):
+    print(f"Память (кэш + очередь записи): {measure_memory(users):.0f} байт/пользователь ({users:,} польз.)")
+    await measure_backend("memory", MemoryStateBackend(), users)
+    with tempfile.TemporaryDirectory() as tmp:
+        backend = SqliteStateBackend(os.path.join(tmp, "state.db"))
+        await measure_backend("sqlite", backend, users)
+        backend.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 100_000))